@@ -0,0 +1,99 @@
+import sys
+import zlib
+import random
+import struct
+import argparse
+from sqlalchemy.orm import sessionmaker
+from memorize.models import blob_digest
+from memorize.storage import DEFAULT_PROFILE, open_engine
+from memorize.importer import NoteFile, ImageFile, AttachmentFile, insert_notes
+from memorize.search import attachment_body
+from memorize.blobs import compress
+
+# Builds synthetic vaults for the benchmarks. Everything is drawn from one
+# seeded generator, so the same parameters always give the same notes.
+
+WORDS = ('memory', 'note', 'cipher', 'tab', 'image', 'sqlite', 'page', 'vault', 'text', 'markdown', 'index',
+         'search', 'thread', 'cache', 'revision', 'blob', 'export', 'import', 'window', 'journal', 'key', 'row')
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+def text(rng, length):
+    words, size = [], 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    lines = [' '.join(words[i:i + 12]) for i in range(0, len(words), 12)]
+    return '\n'.join(lines)[:length]
+
+def png(rng, width, height):
+    # Noise compresses as badly as a photo does, which is the realistic case.
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\0' + rng.randbytes(width * 3) for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows, 1)) + chunk(b'IEND', b''))
+
+def note(rng, index, text_length, images, image_size, attachments, attachment_size):
+    image_files = []
+    for _ in range(images):
+        data = png(rng, *image_size)
+        image_files.append(ImageFile(data, 'png', blob_digest(data)))
+    attachment_files = []
+    for number in range(attachments):
+        data = text(rng, attachment_size).encode('utf-8')
+        payload, compression = compress(data, 'text/plain')
+        attachment_files.append(AttachmentFile(payload, compression, len(data), f'attachment-{index}-{number}.txt',
+                                               'text/plain', blob_digest(data),
+                                               attachment_body(payload, compression, 'text/plain')))
+    return NoteFile(f'note {index}', text(rng, text_length), image_files, attachment_files, [])
+
+def generate(path, password, notes=1000, text_length=2000, images=0, image_size=(640, 480), attachments=0,
+             attachment_size=4096, seed=0, profile=DEFAULT_PROFILE, batch_size=200, progress=None):
+    rng = random.Random(seed)
+    engine = open_engine(path, password, profile=profile)
+    session = sessionmaker(bind=engine)()
+    try:
+        for start in range(0, notes, batch_size):
+            insert_notes(session, [note(rng, index, text_length, images, image_size, attachments, attachment_size)
+                                   for index in range(start, min(start + batch_size, notes))])
+            session.commit()
+            if progress is not None:
+                progress(min(start + batch_size, notes), notes)
+    finally:
+        session.close()
+        engine.dispose()
+
+def add_arguments(parser):
+    parser.add_argument('--notes', type=int, default=1000)
+    parser.add_argument('--text-length', type=int, default=2000)
+    parser.add_argument('--images', type=int, default=0, help='images per note')
+    parser.add_argument('--image-size', type=parse_size, default=(640, 480), metavar='WxH')
+    parser.add_argument('--attachments', type=int, default=0, help='attachments per note')
+    parser.add_argument('--attachment-size', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--kdf-iter', type=int, default=DEFAULT_PROFILE.kdf_iter)
+
+def parameters(args):
+    return {'notes': args.notes, 'text_length': args.text_length, 'images': args.images,
+            'image_size': list(args.image_size), 'attachments': args.attachments,
+            'attachment_size': args.attachment_size, 'seed': args.seed, 'kdf_iter': args.kdf_iter}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic Memorize database.')
+    parser.add_argument('database')
+    parser.add_argument('--password', default='benchmark')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    progress = lambda done, total: print(f'\r{done}/{total}', end='', file=sys.stderr)
+    generate(args.database, args.password, args.notes, args.text_length, args.images, args.image_size,
+             args.attachments, args.attachment_size, args.seed, DEFAULT_PROFILE._replace(kdf_iter=args.kdf_iter),
+             progress=progress)
+    print(file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
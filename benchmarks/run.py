@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import sqlalchemy
+from PySide6 import __version__ as pyside_version
+from PySide6.QtCore import QEventLoop, QSettings
+from PySide6.QtWidgets import QApplication
+from mainwindow import MainWindow, vault_settings_group
+from memorize.storage import DEFAULT_PROFILE, delete_documents, export_document
+from benchmarks.generate import WORDS, generate, add_arguments, parameters, png
+
+# Times what the main window does for each action, from the call to the
+# moment the database worker has delivered the last callback it caused,
+# so a sync includes building the tabs and a save includes serializing
+# them. Before every run the vault is replaced by a copy of the generated
+# one and reopened, untimed, so no run sees what an earlier one changed.
+
+BENCHMARKS = ('connect', 'reopen', 'sync', 'save', 'search', 'export_note', 'load_image', 'delete_note')
+
+class Failed(Exception):
+    pass
+
+def wait(app, window):
+    while window.service.pending:
+        app.processEvents(QEventLoop.WaitForMoreEvents)
+    app.processEvents()
+
+def fail(error):
+    raise Failed(error)
+
+def measure(app, window, action, repeat, setup=None):
+    runs = []
+    for run in range(repeat):
+        if setup is not None:
+            setup(run)
+            wait(app, window)
+        start = time.perf_counter()
+        action(run)
+        wait(app, window)
+        runs.append(time.perf_counter() - start)
+    return {'runs': runs, 'min': min(runs), 'median': statistics.median(runs), 'mean': statistics.fmean(runs)}
+
+def commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+def run(app, window, path, pristine, password, profile, image_path, directory, benchmarks, repeat):
+    tab = lambda: window.ui.tabWidget.currentWidget()
+    open_vault = lambda run, key=None: window.service.open(path, password, profile, key=key,
+                                                           on_done=lambda key: window.connected(path, key), on_error=fail)
+
+    def restore(run, reopen):
+        window.close_connection()
+        wait(app, window)
+        QSettings().remove(vault_settings_group(path) + '/last_tab')
+        for suffix in ('-wal', '-shm', '-journal'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        shutil.copyfile(pristine, path)
+        if reopen:
+            open_vault(run, window.keyCache.get(path))
+            wait(app, window)
+
+    actions = {
+        'connect': (open_vault, None),
+        'reopen': (lambda run: open_vault(run, window.keyCache.get(path)), None),
+        'sync': (lambda run: window.sync_notes(), None),
+        'save': (lambda run: window.save(), lambda run: tab().ui.textEdit.append(f'edit {run}')),
+        'search': (lambda run: window.search_notes(),
+                   lambda run: (window.searchDock.line_edit.setText(random.Random(run).choice(WORDS)),
+                                window.searchDock.timer.stop())),
+        'export_note': (lambda run: window.service.submit(
+            export_document, tab().document_id, os.path.join(directory, f'export-{run}', 'note.md'), on_error=fail),
+            lambda run: os.makedirs(os.path.join(directory, f'export-{run}'))),
+        'load_image': (lambda run: window.ingest_files([image_path]), None),
+        'delete_note': (lambda run: window.service.submit(
+            delete_documents, [max(window.tabs)], on_done=window.remove_tabs, on_error=fail), None),
+    }
+    results = {}
+    for name in BENCHMARKS:
+        # connect always runs: it caches the key that reopen uses.
+        if name not in benchmarks and name != 'connect':
+            continue
+        action, setup = actions[name]
+        reopen = name not in ('connect', 'reopen')
+        result = measure(app, window, action, repeat,
+                         lambda run, setup=setup, reopen=reopen: (restore(run, reopen), setup and setup(run)))
+        if name in benchmarks:
+            results[name] = result
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time Memorize operations on a synthetic database.')
+    add_arguments(parser)
+    parser.add_argument('--database', help='benchmark a copy of this database instead of a generated one')
+    parser.add_argument('--password', default='benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--output', help='write the results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    app = QApplication(sys.argv[:1])
+    app.setOrganizationName('memorize-benchmarks')
+    app.setApplicationName('Memorize')
+    profile = DEFAULT_PROFILE._replace(kdf_iter=args.kdf_iter)
+    directory = tempfile.mkdtemp(prefix='memorize-benchmarks-')
+    try:
+        # Settings and the recent files list stay in the temporary directory.
+        QSettings.setDefaultFormat(QSettings.IniFormat)
+        QSettings.setPath(QSettings.IniFormat, QSettings.UserScope, directory)
+        os.chdir(directory)
+        path = os.path.join(directory, 'vault.db')
+        start = time.perf_counter()
+        if args.database:
+            shutil.copyfile(args.database, path)
+        else:
+            generate(path, args.password, args.notes, args.text_length, args.images, args.image_size,
+                     args.attachments, args.attachment_size, args.seed, profile)
+        generated = time.perf_counter() - start
+        pristine = os.path.join(directory, 'pristine.db')
+        shutil.copyfile(path, pristine)
+        image_path = os.path.join(directory, 'image.png')
+        with open(image_path, 'wb') as file:
+            file.write(png(random.Random(args.seed), *args.image_size))
+
+        window = MainWindow()
+        try:
+            results = run(app, window, path, pristine, args.password, profile, image_path, directory, args.benchmarks,
+                          args.repeat)
+        finally:
+            window.close()
+    finally:
+        os.chdir(os.path.dirname(directory))
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'commit': commit(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'pyside': pyside_version,
+        'parameters': dict(parameters(args), database=args.database, repeat=args.repeat),
+        'generate': generated,
+        'results': results,
+    }
+    output = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'wt') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
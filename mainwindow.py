@@ -6,22 +6,168 @@
 
 import sys
 import os.path
-from os import makedirs
-from shutil import copyfile
+from collections import OrderedDict
+from threading import Event
+from functools import partial
+from hashlib import blake2b
 from mimetypes import guess_type
+from codecs import getincrementaldecoder
 from PySide6.QtWidgets import QApplication, QMainWindow, QFileDialog, QDialog, QTextEdit, QMessageBox, QListWidgetItem
 from PySide6.QtWidgets import QWidget, QLabel, QScrollArea, QSizePolicy, QVBoxLayout, QInputDialog, QLineEdit
-from PySide6.QtGui import QPalette, QPixmap, QImage, QColorSpace, QGuiApplication, QImageReader, QImageWriter, QKeySequence, QPainter, QFont
-from PySide6.QtCore import QDir, QStandardPaths, QByteArray, QBuffer, QIODevice
-from models import Base, Document, Text, Image, Attachment, DocumentText, DocumentImage, DocumentAttachment
-from sqlalchemy import create_engine
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import sessionmaker
+from PySide6.QtWidgets import QDockWidget, QListWidget, QProgressBar, QProgressDialog, QDialogButtonBox, QHBoxLayout
+from PySide6.QtWidgets import QPlainTextEdit
+from PySide6.QtGui import QPalette, QPixmap, QImage, QColorSpace, QImageReader, QImageWriter, QKeySequence, QPainter, QFont
+from PySide6.QtGui import QIcon, QTextCursor, QFontDatabase, QImageIOHandler
+from PySide6.QtCore import QDir, QStandardPaths, QByteArray, QBuffer, QIODevice, QSettings, QTimer, Qt, QSize
+from PySide6.QtCore import QDateTime, QLocale
+from memorize.search import search
+from memorize.storage import list_documents, load_documents, save_texts, add_document, import_document, rename_document
+from memorize.storage import delete_documents, export_document, image_data, read_attachment
+from memorize.storage import save_attachment
+from memorize.storage import set_thumbnail, DEFAULT_PROFILE, EngineProfile
+from memorize.importer import ImageFile, attachment_file, import_directory, ingest_files
+from memorize.models import blob_digest
+from memorize.exporter import export_all
+from memorize.storage import rebuild_search_index
+from worker import DatabaseService
+from renderer import OFF_THREAD_SIZE, RenderCache, RenderService, render_markdown
+from memorize.blobs import is_text
+from memorize.revisions import DEFAULT_RETENTION, RetentionPolicy, list_revisions, revision_text
+from memorize.backup import KEEP_BACKUPS, backup_database, rotate_backups
+from memorize.keys import KeyCache
+from memorize.instrumentation import STATISTICS, enable, profiled, dump_profile, timer, count, database_statistics, report
 from ui_mainwindow import Ui_MainWindow
 from ui_add_note_dialog import Ui_Dialog as Ui_AddNoteDialog
+from ui_delete_notes_dialog import Ui_Dialog as Ui_DeleteNotesDialog
 from ui_about_dialog import Ui_Dialog as Ui_AboutDialog
 from ui_tab import Ui_Form as Ui_Tab
 
+THUMBNAIL_SIZE = QSize(96, 96)
+ORIGINAL_FORMATS = ('png', 'jpeg', 'webp')
+
+def content_hash(content):
+    return blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+def vault_settings_group(path):
+    return 'vaults/' + blake2b(os.path.abspath(path).encode('utf-8'), digest_size=8).hexdigest()
+
+MAX_RECENT = 10
+
+def recent_vaults():
+    # Most recently opened first. Paths from the old prev.txt are taken
+    # over once, the first time the list is read.
+    settings = QSettings()
+    if not settings.contains('recent/paths') and os.path.isfile('prev.txt'):
+        with open('prev.txt', 'rt') as file:
+            paths = [line.strip() for line in file if line.strip()]
+        settings.setValue('recent/paths', list(OrderedDict.fromkeys(reversed(paths)))[:MAX_RECENT])
+    return settings.value('recent/paths', [], type=list)
+
+def remember_vault(path):
+    settings = QSettings()
+    path = os.path.abspath(path)
+    settings.setValue('recent/paths', [path] + [p for p in recent_vaults() if p != path][:MAX_RECENT - 1])
+    group = vault_settings_group(path)
+    settings.setValue(group + '/path', path)
+    settings.setValue(group + '/last_opened', QDateTime.currentDateTime().toString(Qt.ISODate))
+    settings.setValue(group + '/size', os.path.getsize(path))
+
+def engine_profile(path, create_new=False):
+    # Cipher settings belong to the file and are remembered per database;
+    # the rest of the profile is shared and can be changed at any time.
+    settings = QSettings()
+    group = vault_settings_group(path)
+    if create_new:
+        save_cipher_settings(path, cipher_profile())
+    return EngineProfile(
+        kdf_iter=int(settings.value(group + '/kdf_iter', DEFAULT_PROFILE.kdf_iter)),
+        cipher_page_size=int(settings.value(group + '/cipher_page_size', 0)) or None,
+        journal_mode=settings.value('database/journal_mode', DEFAULT_PROFILE.journal_mode),
+        synchronous=settings.value('database/synchronous', DEFAULT_PROFILE.synchronous),
+        cache_size=int(settings.value('database/cache_size', DEFAULT_PROFILE.cache_size)),
+        mmap_size=int(settings.value('database/mmap_size', DEFAULT_PROFILE.mmap_size)),
+        temp_store=settings.value('database/temp_store', DEFAULT_PROFILE.temp_store),
+        echo=settings.value('database/echo', DEFAULT_PROFILE.echo, type=bool))
+
+def backup_directory(path):
+    # One directory per database, so rotation never touches another one's backups.
+    settings = QSettings()
+    locations = QStandardPaths.standardLocations(QStandardPaths.AppDataLocation)
+    directory = settings.value('backup/directory', os.path.join(locations[0] if locations else QDir.currentPath(), 'backups'))
+    return os.path.join(directory, vault_settings_group(path).split('/')[1])
+
+def save_documents(session, contents, documents, policy):
+    # Large rendered notes are serialized here, on the database worker, so
+    # the save stays ordered with the jobs submitted after it.
+    for document_id, document in documents.items():
+        contents[document_id] = document.toMarkdown()
+    documents.clear()
+    save_texts(session, contents, policy)
+    return {document_id: content_hash(content) for document_id, content in contents.items()}
+
+def retention_policy():
+    # A keep_recent below 1 is rejected by the revisions module and would
+    # fail every save, so it falls back to the default.
+    settings = QSettings()
+    keep_recent = int(settings.value('revisions/keep_recent', DEFAULT_RETENTION.keep_recent))
+    return RetentionPolicy(
+        keyframe_interval=int(settings.value('revisions/keyframe_interval', DEFAULT_RETENTION.keyframe_interval)),
+        keep_recent=keep_recent if keep_recent > 0 else DEFAULT_RETENTION.keep_recent,
+        keep_days=int(settings.value('revisions/keep_days', DEFAULT_RETENTION.keep_days)))
+
+def cipher_profile(profile=DEFAULT_PROFILE):
+    # Settings that new and repacked databases are written with.
+    settings = QSettings()
+    return profile._replace(
+        kdf_iter=int(settings.value('database/kdf_iter', DEFAULT_PROFILE.kdf_iter)),
+        cipher_page_size=int(settings.value('database/cipher_page_size', 0)) or None)
+
+def save_cipher_settings(path, profile):
+    settings = QSettings()
+    group = vault_settings_group(path)
+    settings.setValue(group + '/kdf_iter', profile.kdf_iter)
+    settings.setValue(group + '/cipher_page_size', profile.cipher_page_size or 0)
+
+@timer('ui.read_image')
+def read_image(data, bound=None):
+    buffer = QBuffer()
+    buffer.setData(QByteArray(data))
+    buffer.open(QIODevice.ReadOnly)
+    reader = QImageReader(buffer)
+    reader.setAutoTransform(True)
+    # size is the one the image is shown at, after an EXIF rotation;
+    # the scaled size applies to the pixels before it.
+    rotated = bool(reader.transformation() & QImageIOHandler.TransformationRotate90)
+    size = reader.size().transposed() if rotated else reader.size()
+    format = bytes(reader.format()).decode()
+    if bound is not None and size.isValid() and (size.width() > bound.width() or size.height() > bound.height()):
+        scaled = size.scaled(bound, Qt.KeepAspectRatio)
+        reader.setScaledSize(scaled.transposed() if rotated else scaled)
+    image = reader.read()
+    return image, size, format, reader.errorString()
+
+def read_file(path, keep_original=True):
+    # Runs on the ingestion pool, which decodes, thumbnails and hashes.
+    with open(path, 'rb') as file:
+        data = file.read()
+    mime, _ = guess_type(path)
+    if not (mime and mime.startswith('image/')):
+        return attachment_file(data, os.path.basename(path), mime)
+    thumbnail, size, format, error = read_image(data, THUMBNAIL_SIZE)
+    if thumbnail.isNull():
+        raise ValueError(error)
+    if not (keep_original and format in ORIGINAL_FORMATS):
+        data, format = encode_image(read_image(data)[0]), 'png'
+    return ImageFile(data, format, blob_digest(data), encode_image(thumbnail), size.width(), size.height(),
+                     os.path.basename(path))
+
+def encode_image(image, format="PNG"):
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    image.save(buffer, format)
+    return data.data()
+
 class ViewImageDialog(QDialog):
     def __init__(self, parent=None):
         super(ViewImageDialog, self).__init__(parent)
@@ -38,14 +184,24 @@ class ViewImageDialog(QDialog):
         self.layout.addWidget(self.scroll_area)
         self.setLayout(self.layout)
 
+    def set_image_data(self, data):
+        # Decode only as many pixels as fit on screen; the full resolution
+        # image is decoded once the user zooms past that size.
+        self.data = data
+        bound = self.screen().availableSize() * 0.8
+        image, size, _, _ = read_image(data, bound)
+        self.full_resolution = image.size() == size or not size.isValid()
+        self.fitted_size = image.size()
+        self.scale_factor = 1.0
+        self.set_image(image)
+
     def set_image(self, new_image):
         self.image = new_image
         if self.image.colorSpace().isValid():
             self.image.convertToColorSpace(QColorSpace.SRgb)
         self.image_label.setPixmap(QPixmap.fromImage(self.image))
-        self.scale_factor = 1.0
         self.scroll_area.setVisible(True)
-        self.image_label.adjustSize()
+        self.image_label.resize(self.fitted_size * self.scale_factor)
         w = self.image.width()
         h = self.image.height()
         d = self.image.depth()
@@ -53,26 +209,268 @@ class ViewImageDialog(QDialog):
         description = color_space.description() if color_space.isValid() else 'unknown'
         message = f'Opened image, {w}x{h}, Depth: {d} ({description})'
 
+    def zoom(self, factor):
+        self.scale_factor = min(max(self.scale_factor * factor, 0.1), 8.0)
+        if not self.full_resolution and self.scale_factor > 1.0:
+            self.full_resolution = True
+            self.set_image(read_image(self.data)[0])
+        else:
+            self.image_label.resize(self.fitted_size * self.scale_factor)
+
+    def keyPressEvent(self, event):
+        if event.key() in (Qt.Key_Plus, Qt.Key_Equal):
+            self.zoom(1.25)
+        elif event.key() == Qt.Key_Minus:
+            self.zoom(0.8)
+        else:
+            super(ViewImageDialog, self).keyPressEvent(event)
+
+    def wheelEvent(self, event):
+        if event.modifiers() & Qt.ControlModifier:
+            self.zoom(1.25 if event.angleDelta().y() > 0 else 0.8)
+        else:
+            super(ViewImageDialog, self).wheelEvent(event)
+
 class ViewAttachmentDialog(QDialog):
     def __init__(self, parent=None):
         super(ViewAttachmentDialog, self).__init__(parent)
         self.setWindowTitle("Просмотр приложения")
         self.layout = QVBoxLayout()
+        self.label = QLabel()
         self.textEdit = QTextEdit()
         self.textEdit.setReadOnly(True)
+        self.buttonBox = QDialogButtonBox(QDialogButtonBox.Save | QDialogButtonBox.Close)
+        self.buttonBox.rejected.connect(self.reject)
+        self.layout.addWidget(self.label)
         self.layout.addWidget(self.textEdit)
+        self.layout.addWidget(self.buttonBox)
         self.setLayout(self.layout)
+        self.document_attachment_id, self.info = None, None
 
-    def set_content(self, content):
-        self.textEdit.setPlainText(content)
+    def begin(self, document_attachment_id):
+        self.document_attachment_id = document_attachment_id
+        self.decoder = getincrementaldecoder('utf-8')(errors='replace')
+        self.label.clear()
+        self.textEdit.clear()
+        self.textEdit.show()
 
-class Tab(QWidget):
+    def append(self, chunk):
+        cursor = self.textEdit.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(self.decoder.decode(chunk))
+
+    def finish(self, info):
+        self.info = info
+        self.append(b'')
+        self.textEdit.moveCursor(QTextCursor.Start)
+        self.label.setText(f"{info.name or 'Без имени'} ({info.mime}, {info.size} байт)")
+        self.textEdit.setVisible(is_text(info.mime))
+
+class HistoryDialog(QDialog):
+    def __init__(self, parent=None):
+        super(HistoryDialog, self).__init__(parent)
+        self.setWindowTitle("История заметки")
+        self.resize(640, 420)
+        self.layout = QHBoxLayout()
+        self.list_widget = QListWidget()
+        self.list_widget.setMaximumWidth(220)
+        self.textEdit = QTextEdit()
+        self.textEdit.setReadOnly(True)
+        self.buttonBox = QDialogButtonBox(QDialogButtonBox.Close)
+        self.restore_button = self.buttonBox.addButton("Восстановить", QDialogButtonBox.AcceptRole)
+        self.buttonBox.rejected.connect(self.reject)
+        self.buttonBox.accepted.connect(self.accept)
+        right = QVBoxLayout()
+        right.addWidget(self.textEdit)
+        right.addWidget(self.buttonBox)
+        self.layout.addWidget(self.list_widget)
+        self.layout.addLayout(right)
+        self.setLayout(self.layout)
+        self.document_id = None
+
+    def set_revisions(self, document_id, revisions):
+        self.document_id = document_id
+        self.list_widget.clear()
+        self.textEdit.clear()
+        self.restore_button.setEnabled(False)
+        for revision in revisions:
+            item = QListWidgetItem(f"{revision.number}. {revision.created_at.strftime('%c')} ({revision.size} симв.)")
+            item.setToolTip(str(revision.number))
+            self.list_widget.addItem(item)
+
+    def set_text(self, text):
+        self.textEdit.setPlainText(text or '')
+        self.restore_button.setEnabled(text is not None)
+
+class DiagnosticsDialog(QDialog):
     def __init__(self, parent=None):
+        super(DiagnosticsDialog, self).__init__(parent)
+        self.setWindowTitle("Диагностика")
+        self.resize(900, 560)
+        self.layout = QVBoxLayout()
+        self.textEdit = QPlainTextEdit()
+        self.textEdit.setReadOnly(True)
+        self.textEdit.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.textEdit.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.buttonBox = QDialogButtonBox(QDialogButtonBox.Close)
+        self.refresh_button = self.buttonBox.addButton("Обновить", QDialogButtonBox.ActionRole)
+        self.reset_button = self.buttonBox.addButton("Сбросить", QDialogButtonBox.ResetRole)
+        self.buttonBox.rejected.connect(self.reject)
+        self.layout.addWidget(self.textEdit)
+        self.layout.addWidget(self.buttonBox)
+        self.setLayout(self.layout)
+
+    def set_report(self, database=None):
+        self.textEdit.setPlainText(report(STATISTICS, database))
+
+class SearchDock(QDockWidget):
+    def __init__(self, parent=None):
+        super(SearchDock, self).__init__("Поиск", parent)
+        self.widget = QWidget()
+        self.layout = QVBoxLayout()
+        self.line_edit = QLineEdit()
+        self.line_edit.setPlaceholderText("Текст для поиска")
+        self.list_widget = QListWidget()
+        self.list_widget.setWordWrap(True)
+        self.layout.addWidget(self.line_edit)
+        self.layout.addWidget(self.list_widget)
+        self.widget.setLayout(self.layout)
+        self.setWidget(self.widget)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(200)
+        self.line_edit.textChanged.connect(self.timer.start)
+        self.line_edit.returnPressed.connect(self.timer.timeout.emit)
+
+    def set_hits(self, hits):
+        self.list_widget.clear()
+        for hit in hits:
+            kind = "приложение" if hit.kind else "текст"
+            item = QListWidgetItem(f"{hit.name} ({kind})\n{hit.snippet}")
+            item.setToolTip(str(hit.document_id))
+            self.list_widget.addItem(item)
+
+class Tab(QWidget):
+    def __init__(self, document_id, parent=None):
         super(Tab, self).__init__(parent)
+        self.main_window = parent
+        self.layout = QVBoxLayout()
+        self.layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(self.layout)
+        self.document_id = document_id
+        self.body, self.ui = None, None
+        self.reset()
+
+    def reset(self):
+        self.content_hash = None
+        self.dirty = False
+        # In Markdown mode source is the text the view was rendered from.
+        self.markdown = False
+        self.source = None
+        self.rendered_revision = None
+        self.image_ids = ()
+        self.attachment_ids = ()
+
+    def is_loaded(self):
+        return self.ui is not None
+
+    def set_dirty(self, dirty):
+        self.dirty = dirty
+
+    def materialize(self):
+        self.body = QWidget()
         self.ui = Ui_Tab()
-        self.ui.setupUi(self)
-        self.ui.list_widget_images.itemDoubleClicked.connect(parent.show_image)
-        self.ui.list_widget_attachments.itemDoubleClicked.connect(parent.show_attachment)
+        self.ui.setupUi(self.body)
+        self.ui.list_widget_images.setIconSize(THUMBNAIL_SIZE)
+        self.body.setEnabled(False)
+        self.ui.list_widget_images.itemDoubleClicked.connect(self.main_window.show_image)
+        self.ui.list_widget_attachments.itemDoubleClicked.connect(self.main_window.show_attachment)
+        self.ui.button_history.clicked.connect(lambda: self.main_window.show_history(self.document_id))
+        self.ui.textEdit.document().modificationChanged.connect(self.set_dirty)
+        self.layout.addWidget(self.body)
+
+    def release(self):
+        self.layout.removeWidget(self.body)
+        self.body.deleteLater()
+        self.body, self.ui = None, None
+        self.reset()
+
+    def set_content(self, content):
+        digest = content_hash(content)
+        if digest != self.content_hash and not self.dirty:
+            self.content_hash = digest
+            self.show_plain(content)
+            self.mark_saved(digest)
+            if self.main_window.ui.action_format.isChecked():
+                self.main_window.render_tab(self, content)
+
+    def show_plain(self, text):
+        dirty = self.dirty
+        self.ui.textEdit.setPlainText(text)
+        self.ui.textEdit.document().setModified(dirty)
+        self.markdown, self.source, self.rendered_revision = False, None, None
+
+    def show_markdown(self, document, source):
+        # Switching the view is not an edit: the note stays as dirty as it was.
+        dirty = self.dirty
+        previous = self.ui.textEdit.document()
+        # The text edit deletes the document it created itself; clones
+        # swapped in earlier are ours to delete.
+        swapped = previous.parent() is self.ui.textEdit
+        document.setDefaultFont(self.ui.textEdit.font())
+        self.ui.textEdit.setDocument(document)
+        document.modificationChanged.connect(self.set_dirty)
+        if swapped:
+            previous.deleteLater()
+        document.setModified(dirty)
+        self.markdown, self.source, self.rendered_revision = True, source, document.revision()
+
+    def unchanged_since_render(self):
+        return self.markdown and self.ui.textEdit.document().revision() == self.rendered_revision
+
+    def serialize(self):
+        if not self.markdown:
+            return self.ui.textEdit.toPlainText()
+        if self.unchanged_since_render():
+            return self.source
+        return self.ui.textEdit.toMarkdown()
+
+    def mark_saved(self, digest):
+        self.content_hash = digest
+        self.ui.textEdit.document().setModified(False)
+        self.dirty = False
+
+    def set_images(self, images):
+        ids = tuple(image.id for image in images)
+        if ids == self.image_ids:
+            return
+        self.image_ids = ids
+        self.ui.list_widget_images.clear()
+        for image in images:
+            item = QListWidgetItem(image.created_at.strftime("%c"))
+            item.setToolTip(str(image.id))
+            if image.thumbnail:
+                item.setIcon(QIcon(QPixmap.fromImage(QImage.fromData(image.thumbnail))))
+            else:
+                self.main_window.create_thumbnail(image.id)
+            self.ui.list_widget_images.addItem(item)
+
+    def set_thumbnail(self, document_image_id, thumbnail):
+        for i in range(self.ui.list_widget_images.count()):
+            item = self.ui.list_widget_images.item(i)
+            if item.toolTip() == str(document_image_id):
+                item.setIcon(QIcon(QPixmap.fromImage(QImage.fromData(thumbnail))))
+
+    def set_attachments(self, attachments):
+        ids = tuple(attachment.id for attachment in attachments)
+        if ids == self.attachment_ids:
+            return
+        self.attachment_ids = ids
+        self.ui.list_widget_attachments.clear()
+        for attachment in attachments:
+            item = QListWidgetItem(attachment.name or attachment.created_at.strftime("%c"))
+            item.setToolTip(str(attachment.id))
+            self.ui.list_widget_attachments.addItem(item)
 
 class AboutDialog(QDialog):
     def __init__(self, parent=None):
@@ -85,6 +483,22 @@ class AddNoteDialog(QDialog):
         self.ui = Ui_AddNoteDialog()
         self.ui.setupUi(self)
 
+class DeleteNotesDialog(QDialog):
+    def __init__(self, parent=None):
+        super(DeleteNotesDialog, self).__init__(parent)
+        self.ui = Ui_DeleteNotesDialog()
+        self.ui.setupUi(self)
+
+    def set_notes(self, tab_widget):
+        self.ui.listWidget.clear()
+        for index in range(tab_widget.count()):
+            item = QListWidgetItem(tab_widget.tabText(index))
+            item.setToolTip(str(tab_widget.widget(index).document_id))
+            self.ui.listWidget.addItem(item)
+
+    def selected_ids(self):
+        return [int(item.toolTip()) for item in self.ui.listWidget.selectedItems()]
+
 class MainWindow(QMainWindow):
     def __init__(self, parent=None):
         super(MainWindow, self).__init__(parent)
@@ -92,32 +506,58 @@ class MainWindow(QMainWindow):
         self.ui.setupUi(self)
         self.viewImageDialog = ViewImageDialog(self)
         self.viewAttachmentDialog = ViewAttachmentDialog(self)
+        self.viewAttachmentDialog.buttonBox.accepted.connect(self.save_attachment)
+        self.historyDialog = HistoryDialog(self)
+        self.historyDialog.list_widget.currentItemChanged.connect(self.show_revision)
+        self.historyDialog.accepted.connect(self.restore_revision)
         self.addNoteDialog = AddNoteDialog(self)
+        self.deleteNotesDialog = DeleteNotesDialog(self)
         self.aboutDialog = AboutDialog(self)
+        self.diagnosticsDialog = DiagnosticsDialog(self)
+        self.diagnosticsDialog.refresh_button.clicked.connect(self.show_diagnostics)
+        self.diagnosticsDialog.reset_button.clicked.connect(self.reset_diagnostics)
+        self.searchDock = SearchDock(self)
+        self.searchDock.hide()
+        self.addDockWidget(Qt.LeftDockWidgetArea, self.searchDock)
+        self.service = DatabaseService(int(QSettings().value('database/readers', 0)), self)
+        self.renderer = RenderService(self)
+        self.renderCache = RenderCache(int(QSettings().value('render/cache_size', 16)))
+        self.keyCache = KeyCache(int(QSettings().value('security/key_cache_minutes', 15)) * 60)
+        self.backupTimer = QTimer(self)
+        self.backupTimer.timeout.connect(self.backup)
+        self.progressBar = QProgressBar()
+        self.progressBar.setMaximumWidth(160)
+        self.progressBar.hide()
+        self.ui.statusbar.addPermanentWidget(self.progressBar)
         self.current_path = ''
-        self.previous_paths = []
-        self.previous_paths_actions = []
+        self.last_tab = None
         self._font = QFont()
-        self.session, self.engine = None, None
+        self.tabs = {}
+        self.loaded_tabs = OrderedDict()
+        self.max_loaded_tabs = int(QSettings().value('tabs/max_loaded', 8))
 
         self.ui.tabWidget.clear()
-        self.ui.menu_recent.clear()
-        self.load_previous()
+        self.update_recent_menu()
         self.setAcceptDrops(True)
 
         self.addNoteDialog.accepted.connect(self.add_note)
+        self.deleteNotesDialog.accepted.connect(self.delete_selected_notes)
         self.ui.tabWidget.tabBarDoubleClicked.connect(self.rename_note)
         self.ui.tabWidget.tabCloseRequested.connect(self.delete_note)
+        self.ui.tabWidget.currentChanged.connect(self.activate_tab)
 
         self.ui.action_open_database.triggered.connect(self.open_db)
         self.ui.action_create_database.triggered.connect(self.create_db)
         self.ui.action_create_note.triggered.connect(self.addNoteDialog.open)
+        self.ui.action_delete_notes.triggered.connect(self.open_delete_notes)
         self.ui.action_save.triggered.connect(self.save)
         self.ui.action_save_as.triggered.connect(self.save_as)
         self.ui.action_close.triggered.connect(self.close_connection)
         self.ui.action_exit.triggered.connect(self.close_window)
         self.ui.action_export_note.triggered.connect(self.export_note)
+        self.ui.action_export_all.triggered.connect(self.export_all)
         self.ui.action_import_note.triggered.connect(self.import_note)
+        self.ui.action_import_directory.triggered.connect(self.import_directory)
 
         self.ui.action_copy.triggered.connect(lambda _: self.ui.tabWidget.currentWidget().ui.textEdit.copy())
         self.ui.action_paste.triggered.connect(lambda _: self.ui.tabWidget.currentWidget().ui.textEdit.paste())
@@ -132,40 +572,60 @@ class MainWindow(QMainWindow):
         self.ui.action_decrease_text.triggered.connect(self.decrease_font_size)
         self.ui.action_increase_text.triggered.connect(self.increase_font_size)
 
+        self.ui.action_search.triggered.connect(self.open_search)
+        self.ui.action_rebuild_index.triggered.connect(self.rebuild_search_index)
+        self.ui.action_repack.triggered.connect(self.repack_database)
+        self.ui.action_diagnostics.triggered.connect(self.show_diagnostics)
+        self.ui.action_forget_keys.triggered.connect(self.forget_keys)
+        self.searchDock.timer.timeout.connect(self.search_notes)
+        self.searchDock.list_widget.itemActivated.connect(self.show_search_hit)
+
         self.ui.action_about_program.triggered.connect(self.aboutDialog.open)
 
+        self.service.busy.connect(self.set_busy)
+        self.service.failed.connect(self.database_failed)
+        self.service.progress.connect(self.set_progress)
+
     def rename_note(self, tab_index):
-        document = self.session.query(Document).filter(Document.name==self.ui.tabWidget.tabText(tab_index)).one()
+        document_id = self.ui.tabWidget.widget(tab_index).document_id
         new_name, ok = QInputDialog.getText(self, "Введите новое название",
                                         "Название:", QLineEdit.Normal)
         if ok and new_name:
             self.ui.tabWidget.setTabText(tab_index, new_name)
-            document.name = new_name
-            self.session.commit()
+            self.service.submit(rename_document, document_id, new_name)
 
     def delete_note(self, tab_index):
-        document = self.session.query(Document).filter(Document.name==self.ui.tabWidget.tabText(tab_index)).one()
+        name = self.ui.tabWidget.tabText(tab_index)
         msgBox = QMessageBox(self)
-        msgBox.setText(f"Заметка {document.name} будет удалена")
+        msgBox.setText(f"Заметка {name} будет удалена")
         msgBox.setInformativeText("Вы уверены, что хотите удалить эту заметку? Будут также утеряны все приложения.")
         msgBox.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
         if msgBox.exec():
-            try:
-                for text in document.document_texts:
-                    self.session.delete(text.text)
-                    self.session.delete(text)
-                for image in document.document_images:
-                    self.session.delete(image.image)
-                    self.session.delete(image)
-                for attachment in document.document_attachments:
-                    self.session.delete(attachment.attachment)
-                    self.session.delete(attachment)
-                self.session.delete(document)
-                self.session.commit()
-                self.ui.tabWidget.removeTab(tab_index)
-            except SQLAlchemyError as e:
-                self.sesion.rollback()
-                print("!!!", e)
+            self.service.submit(delete_documents, [self.ui.tabWidget.widget(tab_index).document_id],
+                                on_done=self.remove_tabs)
+
+    def open_delete_notes(self):
+        self.deleteNotesDialog.set_notes(self.ui.tabWidget)
+        self.deleteNotesDialog.open()
+
+    def delete_selected_notes(self):
+        document_ids = self.deleteNotesDialog.selected_ids()
+        if not document_ids:
+            return
+        msgBox = QMessageBox(self)
+        msgBox.setText(f"Будет удалено заметок: {len(document_ids)}")
+        msgBox.setInformativeText("Вы уверены, что хотите удалить эти заметки? Будут также утеряны все приложения.")
+        msgBox.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+        if msgBox.exec():
+            self.service.submit(delete_documents, document_ids, on_done=self.remove_tabs)
+
+    def remove_tabs(self, document_ids):
+        for document_id in document_ids:
+            self.loaded_tabs.pop(document_id, None)
+            tab = self.tabs.pop(document_id, None)
+            if tab is not None:
+                self.ui.tabWidget.removeTab(self.ui.tabWidget.indexOf(tab))
+                tab.deleteLater()
 
     def swap_colors(self, state):
         if state:
@@ -173,18 +633,14 @@ class MainWindow(QMainWindow):
         else:
             self.setStyleSheet("")
     def increase_font_size(self):
-        print(self._font.pointSize())
         if self._font.pointSize()<50:
             self._font.setPointSize(self._font.pointSize()+1)
             self.setFont(self._font)
-        print(self._font.pointSize())
 
     def decrease_font_size(self):
-        print(self._font.pointSize())
         if self._font.pointSize()>5:
             self._font.setPointSize(self._font.pointSize()-1)
             self.setFont(self._font)
-        print(self._font.pointSize())
 
     def import_note(self):
         dialog = QFileDialog(self, "Импортировать")
@@ -196,25 +652,74 @@ class MainWindow(QMainWindow):
         dialog.setAcceptMode(QFileDialog.AcceptOpen)
         dialog.setDefaultSuffix("md")
         if (dialog.exec() == QDialog.Accepted):
-            name = os.path.basename(dialog.selectedFiles()[0])
-            contents = ''
-            with open(dialog.selectedFiles()[0], 'rt') as file:
-                contents = file.read()
-            try:
-                document = Document(name=name)
-                text = Text(text=contents)
-                self.session.add(document)
-                self.session.add(text)
-                self.session.commit()
-                document_text = DocumentText(document_id=document.id, text_id=text.id)
-                self.session.add(document_text)
-                self.session.commit()
-                self.save()
-                self.sync_notes()
-            except SQLAlchemyError as e:
-                print(e)
-                self.session.rollback()
-            print(name)
+            self.save()
+            self.service.submit(import_document, dialog.selectedFiles()[0], on_done=lambda _: self.sync_notes())
+
+    def run_with_progress(self, label, function, *args, on_done=None):
+        # function gets the progress callback and cancel check after args
+        # and runs on the database worker behind a cancellable dialog.
+        cancelled = Event()
+        progress = QProgressDialog(label, "Отмена", 0, 0, self)
+        progress.setMinimumDuration(0)
+        progress.canceled.connect(cancelled.set)
+
+        def update(done, total):
+            progress.setMaximum(total)
+            progress.setValue(done)
+
+        def finished(result):
+            self.service.progress.disconnect(update)
+            progress.reset()
+            progress.deleteLater()
+            if on_done is not None:
+                on_done(result)
+
+        def failed(error):
+            print(error)
+            finished(None)
+
+        self.service.progress.connect(update)
+        self.save()
+        self.service.submit(function, *args, self.service.report_progress, cancelled.is_set,
+                            on_done=finished, on_error=failed)
+
+    def import_directory(self):
+        locations = QStandardPaths.standardLocations(QStandardPaths.DocumentsLocation)
+        directory = locations[-1] if locations else QDir.currentPath()
+        directory = QFileDialog.getExistingDirectory(self, "Импортировать папку", directory)
+        if not directory:
+            return
+
+        def imported(result):
+            self.sync_notes()
+            msgBox = QMessageBox(self)
+            msgBox.setText(f"Импортировано заметок: {result.imported}" if result is not None
+                           else "Произошла ошибка при импорте")
+            if result is not None and result.errors:
+                msgBox.setInformativeText(f"Не удалось импортировать файлов: {len(result.errors)}")
+                msgBox.setDetailedText('\n'.join(result.errors))
+            msgBox.open()
+
+        self.run_with_progress("Импорт заметок…", import_directory, directory, on_done=imported)
+
+    def export_all(self):
+        locations = QStandardPaths.standardLocations(QStandardPaths.DocumentsLocation)
+        directory = locations[-1] if locations else QDir.currentPath()
+        filters = ["Папка (*)", "ZIP archive (*.zip)", "TAR archive (*.tar.gz)"]
+        target, selected = QFileDialog.getSaveFileName(self, "Экспортировать все заметки", directory, ';;'.join(filters))
+        if not target:
+            return
+        if selected == filters[1] and not target.endswith('.zip'):
+            target += '.zip'
+        elif selected == filters[2] and not target.endswith(('.tar', '.tar.gz', '.tgz')):
+            target += '.tar.gz'
+
+        def exported(result):
+            message = f"Экспортировано заметок: {result.exported}" if result is not None \
+                else "Произошла ошибка при экспорте"
+            self.ui.statusbar.showMessage(message, 5000)
+
+        self.run_with_progress("Экспорт заметок…", export_all, target, on_done=exported)
 
     def export_note(self):
         dialog = QFileDialog(self, "Экспортировать")
@@ -227,27 +732,7 @@ class MainWindow(QMainWindow):
         dialog.setDefaultSuffix("md")
         if (dialog.exec() == QDialog.Accepted):
             self.save()
-            document = self.session.query(Document).filter(Document.name==self.ui.tabWidget.tabText(self.ui.tabWidget.currentIndex())).one()
-            if document is None:
-                return
-            content = ''
-            for text in document.document_texts:
-                content += text.text.text
-            with open(dialog.selectedFiles()[0], 'wt') as file:
-                file.write(content)
-            dir = os.path.dirname(dialog.selectedFiles()[0])
-            if len(document.document_images) > 0:
-                if not os.path.isdir(os.path.join(dir, 'images')):
-                    makedirs(os.path.join(dir, 'images'))
-                for index, image in enumerate(document.document_images):
-                    with open(os.path.join(dir, 'images', f'{index}.png'), 'wb') as file:
-                        file.write(image.image.image)
-            if len(document.document_attachments) > 0:
-                if not os.path.isdir(os.path.join(dir, 'attachments')):
-                    makedirs(os.path.join(dir, 'attachments'))
-                for index, attachment in enumerate(document.document_attachments):
-                    with open(os.path.join(dir, 'attachments', f'{index}.png'), 'wt') as file:
-                        file.write(attachment.attachment.text)
+            self.service.submit(export_document, self.current_document_id(), dialog.selectedFiles()[0])
 
     def save_as(self):
         dialog = QFileDialog(self, "Сохранить как")
@@ -258,127 +743,294 @@ class MainWindow(QMainWindow):
         dialog.setNameFilters(filters)
         dialog.setAcceptMode(QFileDialog.AcceptSave)
         dialog.setDefaultSuffix("db")
-        if (dialog.exec() == QDialog.Accepted):
-            self.save()
-            copyfile(self.current_path, dialog.selectedFiles()[0])
+        if (dialog.exec() != QDialog.Accepted):
+            return
+        password, ok = QInputDialog.getText(self, "Сохранить как",
+                                            "Новый пароль (оставьте пустым, чтобы не менять):", QLineEdit.Password)
+        if not ok:
+            return
+        target = dialog.selectedFiles()[0]
+        profile = engine_profile(self.current_path)
+        new_profile = cipher_profile(profile) if password else profile
 
-    def add_to_prev_connected(self, path):
-        if not os.path.isfile('prev.txt'):
-            with open('prev.txt', 'wt') as file:
-                file.write(path)
-        else:
-            in_it = False
-            with open('prev.txt', 'rt') as file:
-                for line in file:
-                    if path == line:
-                        in_it = True
-                        break
-            if not in_it:
-                with open('prev.txt', 'at') as file:
-                    file.write('\n'+path)
-
-    def load_previous(self):
-        if os.path.isfile('prev.txt'):
-            with open('prev.txt', 'rt') as file:
-                for line in file:
-                    self.previous_paths.append(line.strip())
-                    action = self.ui.menu_recent.addAction(f'&{line.strip()}')
-                    action.triggered.connect(lambda: self.connect_to_db(line.strip(), False))
-                    self.previous_paths.append(action)
+        def saved(_):
+            save_cipher_settings(target, new_profile)
+            self.ui.statusbar.showMessage(f"Копия сохранена: {QDir.toNativeSeparators(target)}", 5000)
+
+        def failed(error):
+            print(error)
+            msgBox = QMessageBox(self)
+            msgBox.setText("Не удалось сохранить копию базы данных")
+            msgBox.open()
+
+        # On the writer, so the copy includes the edits saved just before.
+        self.save()
+        self.service.submit_with_location(backup_database, target, password or None, new_profile,
+                                          self.service.report_progress, on_done=saved, on_error=failed)
+
+    def backup(self):
+        if not self.current_path:
+            return
+        settings = QSettings()
+        keep = int(settings.value('backup/keep', KEEP_BACKUPS))
+        # On the writer, like save_as: a reader could copy the file before
+        # the save queued just ahead of it commits.
+        self.save()
+        self.service.submit_with_location(
+            rotate_backups, backup_directory(self.current_path), keep, self.service.report_progress,
+            on_done=self.backed_up)
+
+    def backed_up(self, target):
+        if target is not None:
+            self.ui.statusbar.showMessage(f"Резервная копия создана: {QDir.toNativeSeparators(target)}", 5000)
+
+    def update_recent_menu(self):
+        settings = QSettings()
+        locale = QLocale()
+        self.ui.menu_recent.clear()
+        for path in recent_vaults():
+            group = vault_settings_group(path)
+            action = self.ui.menu_recent.addAction(QDir.toNativeSeparators(path))
+            action.setEnabled(os.path.isfile(path))
+            last_opened = QDateTime.fromString(settings.value(group + '/last_opened', ''), Qt.ISODate)
+            if last_opened.isValid():
+                size = locale.formattedDataSize(int(settings.value(group + '/size', 0)))
+                action.setStatusTip(f"Открыта {locale.toString(last_opened, QLocale.ShortFormat)}, {size}")
+            action.triggered.connect(partial(self.connect_to_db, path, False))
+
+    def remember_tab(self):
+        document_id = self.current_document_id()
+        if self.current_path and document_id is not None:
+            QSettings().setValue(vault_settings_group(self.current_path) + '/last_tab', document_id)
+
+    def forget_keys(self):
+        self.keyCache.clear()
+        self.ui.statusbar.showMessage("Сохранённые ключи забыты", 5000)
+
+    def open_search(self):
+        self.searchDock.show()
+        self.searchDock.line_edit.setFocus()
+        self.searchDock.line_edit.selectAll()
+
+    def search_notes(self):
+        # Searches what is saved; saving here would add a revision on every
+        # pause in typing.
+        if not self.current_path:
+            return
+        self.service.submit(search, self.searchDock.line_edit.text(),
+                            on_done=self.searchDock.set_hits, read_only=True)
+
+    def show_search_hit(self, hit_item):
+        tab = self.tabs.get(int(hit_item.toolTip()))
+        if tab is not None:
+            self.ui.tabWidget.setCurrentWidget(tab)
+
+    def rebuild_search_index(self):
+        if not self.current_path:
+            return
+        self.save()
+        self.service.submit(rebuild_search_index,
+                            on_done=lambda _: self.ui.statusbar.showMessage("Поисковый индекс перестроен", 5000))
+
+    def repack_database(self):
+        if not self.current_path:
+            return
+        password, ok = QInputDialog.getText(self, "Перепаковать базу данных",
+                                            "Новый пароль (оставьте пустым, чтобы не менять):", QLineEdit.Password)
+        if not ok:
+            return
+        # A vault opened with a cached key has no password to re-key with.
+        current_password = None
+        if not password and self.service.writer.password is None:
+            current_password, ok = QInputDialog.getText(self, "Перепаковать базу данных",
+                                                        "Текущий пароль:", QLineEdit.Password)
+            if not (ok and current_password):
+                return
+        path = self.current_path
+        profile = cipher_profile(engine_profile(path))
+
+        def repacked(key):
+            save_cipher_settings(path, profile)
+            self.keyCache.forget(path)
+            self.keyCache.put(path, key)
+            self.ui.statusbar.showMessage("База данных перепакована", 5000)
+
+        def failed(error):
+            print(error)
+            msgBox = QMessageBox(self)
+            msgBox.setText("Не удалось перепаковать базу данных")
+            msgBox.open()
+
+        self.save()
+        self.service.repack(password, profile, on_done=repacked, on_error=failed, password=current_password)
+
+    def show_diagnostics(self):
+        self.diagnosticsDialog.set_report()
+        self.diagnosticsDialog.show()
+        if self.current_path:
+            self.service.submit(database_statistics, on_done=self.diagnosticsDialog.set_report, read_only=True)
+
+    def reset_diagnostics(self):
+        STATISTICS.reset()
+        self.show_diagnostics()
 
     def show_image(self, image_item):
-        document_image = self.session.query(DocumentImage).filter(DocumentImage.id==int(image_item.toolTip())).one_or_none()
-        if not document_image:
+        self.service.submit(image_data, int(image_item.toolTip()), on_done=self.view_image, read_only=True)
+
+    def view_image(self, image_bytes):
+        if not image_bytes:
             return
-        image_bytes = document_image.image.image
-        image_obj = QPixmap()
-        image_obj.loadFromData(image_bytes, "PNG")
-        image_obj = image_obj.toImage()
-        self.viewImageDialog.set_image(image_obj)
+        self.viewImageDialog.set_image_data(image_bytes)
         self.viewImageDialog.show()
 
+    def create_thumbnail(self, document_image_id):
+        def created(image_bytes):
+            if not image_bytes:
+                return
+            thumbnail = encode_image(read_image(image_bytes, THUMBNAIL_SIZE)[0])
+            self.service.submit(set_thumbnail, document_image_id, thumbnail)
+            for tab in self.loaded_tabs.values():
+                if document_image_id in tab.image_ids:
+                    tab.set_thumbnail(document_image_id, thumbnail)
+        self.service.submit(image_data, document_image_id, on_done=created, read_only=True)
+
     def show_attachment(self, attachment_item):
-        document_attachment = self.session.query(DocumentAttachment).filter(DocumentAttachment.id==int(attachment_item.toolTip())).one_or_none()
-        if not document_attachment:
+        self.viewAttachmentDialog.begin(int(attachment_item.toolTip()))
+        self.service.stream(read_attachment, int(attachment_item.toolTip()), on_chunk=self.viewAttachmentDialog.append,
+                            on_done=self.view_attachment, read_only=True)
+
+    def view_attachment(self, info):
+        if info is None:
             return
-        self.viewAttachmentDialog.set_content(document_attachment.attachment.text)
+        self.viewAttachmentDialog.finish(info)
         self.viewAttachmentDialog.show()
 
+    def save_attachment(self):
+        document_attachment_id = self.viewAttachmentDialog.document_attachment_id
+        name = self.viewAttachmentDialog.info.name or ''
+        locations = QStandardPaths.standardLocations(QStandardPaths.DownloadLocation)
+        directory = locations[-1] if locations else QDir.currentPath()
+        path, _ = QFileDialog.getSaveFileName(self, "Сохранить приложение", os.path.join(directory, name))
+        if path:
+            self.service.submit(save_attachment, document_attachment_id, path, read_only=True)
+
+    def show_history(self, document_id):
+        self.save()
+        self.service.submit(list_revisions, document_id,
+                            on_done=lambda revisions: self.view_history(document_id, revisions))
+
+    def view_history(self, document_id, revisions):
+        self.historyDialog.set_revisions(document_id, revisions)
+        self.historyDialog.open()
+
+    def show_revision(self, item):
+        if item is None:
+            return
+        self.historyDialog.set_text(None)
+        self.service.submit(revision_text, self.historyDialog.document_id, int(item.toolTip()),
+                            on_done=self.historyDialog.set_text, read_only=True)
+
+    def restore_revision(self):
+        tab = self.tabs.get(self.historyDialog.document_id)
+        if tab is None or not self.historyDialog.restore_button.isEnabled():
+            return
+        self.ui.tabWidget.setCurrentWidget(tab)
+        text = self.historyDialog.textEdit.toPlainText()
+        tab.show_plain(text)
+        tab.ui.textEdit.document().setModified(True)
+        if self.ui.action_format.isChecked():
+            self.render_tab(tab, text)
+
     def set_format(self, enabled):
-        if None in (self.engine, self.session):
+        tab = self.ui.tabWidget.currentWidget()
+        if not self.current_path or tab is None or not tab.is_loaded() or tab.markdown == enabled:
             return
         if enabled:
-            text = self.ui.tabWidget.currentWidget().ui.textEdit.toPlainText()
-            self.ui.tabWidget.currentWidget().ui.textEdit.setMarkdown(text)
+            self.render_tab(tab, tab.ui.textEdit.toPlainText())
+        else:
+            self.unrender_tab(tab)
+
+    def render_tab(self, tab, text):
+        # Rendered notes are cached by content, so switching an unchanged
+        # note back to Markdown only clones the cached document.
+        key = (tab.document_id, content_hash(text))
+        document = self.renderCache.get(key)
+        if document is not None:
+            tab.show_markdown(document.clone(tab.ui.textEdit), text)
+            return
+        ui, revision = tab.ui, tab.ui.textEdit.document().revision()
+
+        def rendered(document):
+            self.renderCache.put(key, document)
+            if self.tabs.get(tab.document_id) is not tab or tab.ui is not ui:
+                return
+            ui.textEdit.setReadOnly(False)
+            if (not tab.markdown and self.ui.action_format.isChecked()
+                    and ui.textEdit.document().revision() == revision):
+                tab.show_markdown(document.clone(ui.textEdit), text)
+
+        if len(text) < OFF_THREAD_SIZE:
+            with timer('ui.render_markdown'):
+                rendered(render_markdown(text))
         else:
-            text = self.ui.tabWidget.currentWidget().ui.textEdit.toMarkdown()
-            self.ui.tabWidget.currentWidget().ui.textEdit.setPlainText(text)
+            ui.textEdit.setReadOnly(True)
+            self.renderer.render(tab.document_id, text, rendered)
+
+    def unrender_tab(self, tab):
+        if tab.unchanged_since_render():
+            tab.show_plain(tab.source)
+            return
+        ui, document = tab.ui, tab.ui.textEdit.document()
+        if document.characterCount() < OFF_THREAD_SIZE:
+            with timer('ui.to_markdown'):
+                tab.show_plain(document.toMarkdown())
+            return
+        revision = document.revision()
+
+        def serialized(text):
+            if self.tabs.get(tab.document_id) is not tab or tab.ui is not ui:
+                return
+            ui.textEdit.setReadOnly(False)
+            if (tab.markdown and not self.ui.action_format.isChecked()
+                    and ui.textEdit.document().revision() == revision):
+                tab.show_plain(text)
+
+        ui.textEdit.setReadOnly(True)
+        self.renderer.serialize(tab.document_id, document.clone(), serialized)
 
     def dragEnterEvent(self, event):
-        if None in (self.engine, self.session):
+        if not self.current_path:
             return
-        print(event.mimeData().formats())
         if event.mimeData().hasUrls():
             event.accept()
         else:
             event.ignore()
 
-    def load_image(self, url):
-        reader = QImageReader(url)
-        reader.setAutoTransform(True)
-        new_image = reader.read()
-        if new_image.isNull():
-            error = reader.errorString()
-            QMessageBox.information(self, QGuiApplication.applicationDisplayName(),
-                                    f"Cannot load {QDir.toNativeSeparators(url)}: {error}")
-            return
-        try:
-            pixmap = QPixmap.fromImage(new_image)
-            bytes = QByteArray()
-            buffer = QBuffer(bytes)
-            buffer.open(QIODevice.WriteOnly)
-            pixmap.save(buffer, "PNG")
-            image = Image(image=bytes)
-            self.session.add(image)
-            self.session.commit()
-            document = self.session.query(Document).filter(Document.name==self.ui.tabWidget.tabText(self.ui.tabWidget.currentIndex())).one()
-            document_image = DocumentImage(document_id=document.id, image_id=image.id)
-            self.session.add(document_image)
-            self.session.commit()
-            self.save()
-            self.sync_notes()
-        except SQLAlchemyError as e:
-            print(e)
-            self.session.rollback()
-
-    def load_attachment(self, url):
-        with open(url, 'rb') as file:
-            try:
-                attachment_bytes = file.read()
-                attachment = Attachment(text=attachment_bytes.decode('utf-8'))
-                self.session.add(attachment)
-                self.session.commit()
-                document = self.session.query(Document).filter(Document.name==self.ui.tabWidget.tabText(self.ui.tabWidget.currentIndex())).one()
-                document_attachment = DocumentAttachment(document_id=document.id, attachment_id=attachment.id)
-                self.session.add(document_attachment)
-                self.session.commit()
-                self.save()
-                self.sync_notes()
-            except SQLAlchemyError as e:
-                print(e)
-                self.session.rollback()
-
     def dropEvent(self, event):
-        if not event.mimeData().urls()[0].isLocalFile():
+        self.ingest_files([url.toLocalFile() for url in event.mimeData().urls() if url.isLocalFile()])
+
+    def ingest_files(self, paths):
+        tab = self.ui.tabWidget.currentWidget()
+        if tab is None or not paths:
             return
-        url = event.mimeData().urls()[0].toLocalFile()
-        mime, _ = guess_type(url)
-        if mime.split('/')[0] == 'image':
-            self.load_image(url)
-        else:
-            self.load_attachment(url)
-        # self.viewImageDialog.exec()
-        print(event.mimeData().text())
+        keep_original = QSettings().value('images/keep_original_format', True, type=bool)
+
+        def ingested(result):
+            if self.tabs.get(tab.document_id) is tab and tab.is_loaded():
+                self.refresh_tabs([tab])
+            if result is not None and not result.errors:
+                self.ui.statusbar.showMessage(f"Добавлено файлов: {result.imported}", 5000)
+                return
+            msgBox = QMessageBox(self)
+            msgBox.setText(f"Добавлено файлов: {result.imported}" if result is not None
+                           else "Произошла ошибка при добавлении файлов")
+            if result is not None:
+                msgBox.setInformativeText(f"Не удалось добавить файлов: {len(result.errors)}")
+                msgBox.setDetailedText('\n'.join(result.errors))
+            msgBox.open()
+
+        self.run_with_progress("Добавление файлов…", ingest_files, tab.document_id, paths,
+                               partial(read_file, keep_original=keep_original), on_done=ingested)
 
     def create_db(self):
         dialog = QFileDialog()
@@ -395,33 +1047,75 @@ class MainWindow(QMainWindow):
             self.connect_to_db(strFile[0], False)
 
     def connect_to_db(self, path, create_new):
-        print(path)
         if not (create_new or os.path.isfile(path)):
             return
-        password, ok = QInputDialog.getText(self, "Введите пароль для базы данных",
-                                        "Password:", QLineEdit.Password)
-        if ok and password:
-            try:
-                self.engine = create_engine(f'sqlite+pysqlcipher://:{password}@//{path}?cipher=aes-256-cfb&kdf_iter=64000', echo=True)
-                self.session = sessionmaker(bind=self.engine)()
-                self.current_path = path
-                Base.metadata.create_all(bind=self.engine)
-                self.add_to_prev_connected(path)
-                self.sync_notes()
-                self.action_toggle(True)
-            except SQLAlchemyError as e:
-                msgBox = QMessageBox()
-                msgBox.setText("Произошла ошибка при открытии базы данных. \nПроверьте, что вы ввели правильный пароль.")
-                msgBox.exec()
+        # A key cached from a recent unlock opens the vault without a prompt.
+        key = None if create_new else self.keyCache.get(path)
+        password = None
+        if key is None:
+            password, ok = QInputDialog.getText(self, "Введите пароль для базы данных",
+                                            "Password:", QLineEdit.Password)
+            if not (ok and password):
+                return
+        self.close_connection()
+        self.ui.statusbar.showMessage("Открытие базы данных…")
+        self.service.open(path, password, engine_profile(path, create_new),
+                          on_done=lambda result: self.connected(path, result),
+                          on_error=lambda error: self.connect_failed(path, error, key is not None), key=key)
+
+    def connected(self, path, key):
+        self.current_path = path
+        self.ui.statusbar.clearMessage()
+        self.keyCache.put(path, key)
+        remember_vault(path)
+        self.update_recent_menu()
+        last_tab = QSettings().value(vault_settings_group(path) + '/last_tab')
+        self.last_tab = int(last_tab) if last_tab is not None else None
+        self.sync_notes()
+        self.action_toggle(True)
+        # Scheduled backups are off unless backup/interval (minutes) is set.
+        interval = int(QSettings().value('backup/interval', 0))
+        if interval > 0:
+            self.backupTimer.start(interval * 60000)
+
+    def connect_failed(self, path, error, cached):
+        print(error)
+        self.ui.statusbar.clearMessage()
+        if cached:
+            # The file was re-keyed elsewhere; ask for the password instead.
+            self.keyCache.forget(path)
+            self.connect_to_db(path, False)
+            return
+        msgBox = QMessageBox()
+        msgBox.setText("Произошла ошибка при открытии базы данных. \nПроверьте, что вы ввели правильный пароль.")
+        msgBox.exec()
+
+    def database_failed(self, error):
+        print(error)
+        self.ui.statusbar.showMessage(f"Ошибка базы данных: {error}", 10000)
+
+    def set_busy(self, busy):
+        self.progressBar.setRange(0, 0)
+        self.progressBar.setVisible(busy)
+
+    def set_progress(self, done, total):
+        self.progressBar.setRange(0, total)
+        self.progressBar.setValue(done)
 
     def action_toggle(self, enable):
         self.ui.action_close.setEnabled(enable)
         self.ui.action_create_database.setEnabled(enable)
         self.ui.action_create_note.setEnabled(enable)
+        self.ui.action_delete_notes.setEnabled(enable)
         self.ui.action_save.setEnabled(enable)
         self.ui.action_save_as.setEnabled(enable)
         self.ui.action_import_note.setEnabled(enable)
+        self.ui.action_import_directory.setEnabled(enable)
         self.ui.action_export_note.setEnabled(enable)
+        self.ui.action_export_all.setEnabled(enable)
+        self.ui.action_search.setEnabled(enable)
+        self.ui.action_rebuild_index.setEnabled(enable)
+        self.ui.action_repack.setEnabled(enable)
 
         self.ui.action_copy.setEnabled(enable)
         self.ui.action_paste.setEnabled(enable)
@@ -431,83 +1125,157 @@ class MainWindow(QMainWindow):
         self.ui.action_select_all.setEnabled(enable)
 
     def close_connection(self):
-        if None in (self.engine, self.session):
+        if not self.current_path:
             return
-        self.session.close()
-        self.engine.dispose()
+        self.remember_tab()
+        self.backupTimer.stop()
+        self.service.close()
+        self.renderCache.clear()
         self.current_path = ''
-        self.session, self.engine = None, None
         self.ui.tabWidget.clear()
+        self.searchDock.list_widget.clear()
+        for tab in self.tabs.values():
+            tab.deleteLater()
+        self.tabs = {}
+        self.loaded_tabs.clear()
         self.action_toggle(False)
 
     def close_window(self):
         self.close_connection()
         QApplication.closeAllWindows()
 
+    def closeEvent(self, event):
+        self.remember_tab()
+        self.service.shutdown()
+        self.renderer.shutdown()
+        super(MainWindow, self).closeEvent(event)
+
     def add_note(self):
-        if None in (self.engine, self.session):
+        if not self.current_path:
             return
         name = self.addNoteDialog.ui.lineEdit.text()
-        try:
-            document = Document(name=name)
-            text = Text(text='')
-            self.session.add(document)
-            self.session.add(text)
-            self.session.commit()
-            document_text = DocumentText(document_id=document.id, text_id=text.id)
-            self.session.add(document_text)
-            self.session.commit()
-            self.save()
-            self.sync_notes()
-        except SQLAlchemyError as e:
-            print(e)
-            self.session.rollback()
-        print(name)
+        self.save()
+        self.service.submit(add_document, name, on_done=lambda _: self.sync_notes())
 
-    def sync_notes(self):
-        if None in (self.engine, self.session):
+    def current_document_id(self):
+        tab = self.ui.tabWidget.currentWidget()
+        return tab.document_id if tab is not None else None
+
+    def activate_tab(self, tab_index):
+        tab = self.ui.tabWidget.widget(tab_index)
+        if tab is None or not self.current_path:
             return
-        current_tab = self.ui.tabWidget.currentIndex()
-        self.ui.tabWidget.clear()
-        documents = self.session.query(Document).all()
+        count('loaded tabs', tab.is_loaded())
+        if not tab.is_loaded():
+            tab.materialize()
+            self.refresh_tabs([tab])
+        elif tab.markdown != self.ui.action_format.isChecked():
+            self.set_format(self.ui.action_format.isChecked())
+        self.loaded_tabs[tab.document_id] = tab
+        self.loaded_tabs.move_to_end(tab.document_id)
+        self.release_tabs()
+
+    def release_tabs(self):
+        for document_id, tab in list(self.loaded_tabs.items()):
+            if len(self.loaded_tabs) <= self.max_loaded_tabs:
+                break
+            if tab is self.ui.tabWidget.currentWidget() or tab.dirty:
+                continue
+            tab.release()
+            del self.loaded_tabs[document_id]
+
+    def refresh_tabs(self, tabs):
+        document_ids = [tab.document_id for tab in tabs]
+        if document_ids:
+            self.service.submit(load_documents, document_ids, on_done=self.fill_tabs)
+
+    @timer('ui.fill_tabs')
+    def fill_tabs(self, documents):
         for document in documents:
-            texts = document.document_texts
-            images = document.document_images
-            attachments = document.document_attachments
-            tab = Tab(self)
-            content = ''
-            for text in texts:
-                content += text.text.text
-            for image in images:
-                item = QListWidgetItem(image.image.created_at.strftime("%c"))
-                item.setToolTip(str(image.id))
-                tab.ui.list_widget_images.addItem(item)
-            for attachment in attachments:
-                item = QListWidgetItem(attachment.attachment.created_at.strftime("%c"))
-                item.setToolTip(str(attachment.id))
-                tab.ui.list_widget_attachments.addItem(item)
-            tab.ui.textEdit.setPlainText(content)
-            self.ui.tabWidget.addTab(tab, document.name)
-        self.ui.tabWidget.setCurrentIndex(current_tab)
+            tab = self.tabs.get(document.id)
+            if tab is None or not tab.is_loaded():
+                continue
+            tab.set_content(document.content)
+            tab.set_images(document.images)
+            tab.set_attachments(document.attachments)
+            tab.body.setEnabled(True)
 
+    def sync_notes(self):
+        if not self.current_path:
+            return
+        self.service.submit(list_documents, on_done=self.apply_documents)
+
+    @timer('ui.apply_documents')
+    def apply_documents(self, documents):
+        if not self.current_path:
+            return
+        current_id = self.current_document_id() or self.last_tab
+        self.last_tab = None
+        ids = {document.id for document in documents}
+        self.ui.tabWidget.blockSignals(True)
+        for document_id in [i for i in self.tabs if i not in ids]:
+            tab = self.tabs.pop(document_id)
+            self.loaded_tabs.pop(document_id, None)
+            self.ui.tabWidget.removeTab(self.ui.tabWidget.indexOf(tab))
+            tab.deleteLater()
+        for index, document in enumerate(documents):
+            tab = self.tabs.get(document.id)
+            if tab is None:
+                tab = Tab(document.id, self)
+                self.tabs[document.id] = tab
+                self.ui.tabWidget.insertTab(index, tab, document.name)
+            elif self.ui.tabWidget.tabText(self.ui.tabWidget.indexOf(tab)) != document.name:
+                self.ui.tabWidget.setTabText(self.ui.tabWidget.indexOf(tab), document.name)
+        if current_id in self.tabs:
+            self.ui.tabWidget.setCurrentWidget(self.tabs[current_id])
+        self.ui.tabWidget.blockSignals(False)
+        self.refresh_tabs(self.loaded_tabs.values())
+        self.activate_tab(self.ui.tabWidget.currentIndex())
+
+    @timer('ui.save')
     def save(self):
-        if None in (self.engine, self.session):
+        if not self.current_path:
             return
-        for i in range(self.ui.tabWidget.count()):
-            tab = self.ui.tabWidget.widget(i)
-            contents = ''
-            if self.ui.action_format.isChecked():
-                contents = tab.ui.textEdit.toMarkdown()
+        contents, documents, revisions = {}, {}, {}
+        for tab in self.loaded_tabs.values():
+            if not tab.dirty:
+                continue
+            document = tab.ui.textEdit.document()
+            if tab.markdown and not tab.unchanged_since_render() and document.characterCount() >= OFF_THREAD_SIZE:
+                documents[tab.document_id] = document.clone()
+                documents[tab.document_id].moveToThread(self.service.writer.thread())
+                revisions[tab.document_id] = document.revision()
+                continue
+            content = tab.serialize()
+            digest = content_hash(content)
+            if digest == tab.content_hash:
+                tab.mark_saved(digest)
             else:
-                contents = tab.ui.textEdit.toPlainText()
-            document = self.session.query(Document).filter(Document.name==self.ui.tabWidget.tabText(i)).one()
-            document.document_texts[0].text.text = contents
-            self.session.commit()
+                contents[tab.document_id] = content
+                revisions[tab.document_id] = document.revision()
+        if contents or documents:
+            self.service.submit(save_documents, contents, documents, retention_policy(),
+                                on_done=lambda digests: self.saved(digests, revisions))
 
+    def saved(self, digests, revisions):
+        for document_id, digest in digests.items():
+            tab = self.tabs.get(document_id)
+            if tab is None or not tab.is_loaded():
+                continue
+            if tab.ui.textEdit.document().revision() == revisions[document_id]:
+                tab.mark_saved(digest)
+            else:
+                tab.content_hash = digest
 
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    app.setOrganizationName("memorize")
+    app.setApplicationName("Memorize")
+    enable()
     widget = MainWindow()
     widget.show()
-    sys.exit(app.exec())
+    with profiled():
+        status = app.exec()
+    dump_profile()
+    sys.exit(status)
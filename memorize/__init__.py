@@ -0,0 +1,8 @@
+# Vault is loaded on first use so that `python -m memorize` can parse its
+# arguments before SQLAlchemy is imported.
+
+def __getattr__(name):
+    if name == 'Vault':
+        from .vault import Vault
+        return Vault
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,92 @@
+import os
+import os.path
+import re
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+from .storage import engine_url, export_database
+
+# Backups are taken from a connection of their own, so they see one
+# consistent snapshot of the database, including transactions that are
+# still in the WAL, while the application keeps working. Without a new
+# key the pages are copied as they are with the online backup API, a
+# step at a time; re-keying goes through sqlcipher_export instead, as the
+# backup API can only copy between databases with the same key.
+
+BACKUP_PAGES = 256
+KEEP_BACKUPS = 7
+STAMP = '%Y%m%d-%H%M%S'
+
+def same_cipher(profile, new_profile):
+    return (profile.kdf_iter, profile.cipher_page_size) == (new_profile.kdf_iter, new_profile.cipher_page_size)
+
+def copy_pages(path, password, profile, target, progress=None, pages=BACKUP_PAGES):
+    source_engine = create_engine(engine_url(path, password, profile), poolclass=NullPool)
+    target_engine = create_engine(engine_url(target, password, profile), poolclass=NullPool)
+    source, destination = source_engine.raw_connection(), target_engine.raw_connection()
+    try:
+        # Driver builds without the backup API return False.
+        if not hasattr(source.driver_connection, 'backup'):
+            return False
+        report = None if progress is None else lambda status, remaining, total: progress(total - remaining, total)
+        source.driver_connection.backup(destination.driver_connection, pages=pages, progress=report)
+        return True
+    finally:
+        destination.close()
+        source.close()
+        target_engine.dispose()
+        source_engine.dispose()
+
+def backup_database(path, password, profile, target, new_password=None, new_profile=None, progress=None,
+                    pages=BACKUP_PAGES):
+    # The copy is written next to target and only renamed once complete.
+    if os.path.abspath(target) == os.path.abspath(path):
+        raise ValueError('a database cannot be backed up onto itself')
+    new_password, new_profile = new_password or password, new_profile or profile
+    partial = target + '.part'
+    if os.path.exists(partial):
+        os.remove(partial)
+    try:
+        if not (new_password == password and same_cipher(profile, new_profile)
+                and copy_pages(path, password, profile, partial, progress, pages)):
+            if os.path.exists(partial):
+                os.remove(partial)
+            export_database(path, password, profile, partial, new_password, new_profile)
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, target)
+    return target
+
+def fingerprint(path):
+    # Every commit changes the database file or its WAL. A checkpoint can
+    # change it without new data, which only costs a redundant backup.
+    stats = [os.stat(name) for name in (path, path + '-wal') if os.path.exists(name)]
+    return ' '.join(f'{stat.st_size}:{stat.st_mtime_ns}' for stat in stats)
+
+def list_backups(path, directory):
+    stem, extension = os.path.splitext(os.path.basename(path))
+    pattern = re.compile(re.escape(stem) + r'-\d{8}-\d{6}' + re.escape(extension) + '$')
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if pattern.match(name))
+
+def rotate_backups(path, password, profile, directory, keep=KEEP_BACKUPS, progress=None, now=None):
+    # Returns the new backup, or None when nothing changed since the last.
+    stem, extension = os.path.splitext(os.path.basename(path))
+    state = os.path.join(directory, stem + '.last')
+    current = fingerprint(path)
+    backups = list_backups(path, directory)
+    if backups and os.path.exists(state):
+        with open(state, 'rt') as file:
+            if file.read() == current:
+                return None
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.join(directory, f'{stem}-{(now or datetime.now()).strftime(STAMP)}{extension}')
+    backup_database(path, password, profile, target, progress=progress)
+    with open(state, 'wt') as file:
+        file.write(current)
+    for name in list_backups(path, directory)[:-keep]:
+        os.remove(name)
+    return target
@@ -0,0 +1,62 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Attachments are stored as raw bytes, compressed per blob with zstd when
+# the zstandard package is installed and zlib otherwise. The method is
+# recorded next to the payload, so databases written with zstd need it
+# to be installed to read those blobs back.
+NONE, ZLIB, ZSTD = '', 'zlib', 'zstd'
+MIN_SIZE = 512
+COMPRESSED_TYPES = ('image/', 'audio/', 'video/', 'font/woff', 'application/zip', 'application/gzip',
+                    'application/x-gzip', 'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed',
+                    'application/x-rar-compressed', 'application/vnd.rar', 'application/zstd', 'application/pdf',
+                    'application/vnd.openxmlformats-officedocument', 'application/vnd.oasis.opendocument',
+                    'application/epub+zip', 'application/java-archive')
+TEXT_TYPES = ('application/json', 'application/xml', 'application/javascript', 'application/x-sh',
+              'application/x-python', 'application/sql', 'application/x-yaml', 'application/toml')
+
+def is_text(mime):
+    return bool(mime) and (mime.startswith('text/') or mime.startswith(TEXT_TYPES) or mime.endswith('+xml'))
+
+def is_compressed(mime):
+    return bool(mime) and mime.startswith(COMPRESSED_TYPES) and not mime.endswith('+xml')
+
+def compress(data, mime=None):
+    # Small blobs and formats that are compressed already are kept as they
+    # are, and so is anything that shrinks by less than an eighth.
+    if len(data) < MIN_SIZE or is_compressed(mime):
+        return data, NONE
+    if zstandard is not None:
+        payload, method = zstandard.ZstdCompressor(level=3).compress(data), ZSTD
+    else:
+        payload, method = zlib.compress(data, 6), ZLIB
+    if len(payload) > len(data) - len(data) // 8:
+        return data, NONE
+    return payload, method
+
+def decompressor(method):
+    if method == ZLIB:
+        return zlib.decompressobj()
+    if method == ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read this attachment')
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+def decompress_stream(chunks, method):
+    decoder = decompressor(method)
+    for chunk in chunks:
+        data = decoder.decompress(chunk) if decoder is not None else chunk
+        if data:
+            yield data
+    if method == ZLIB:
+        data = decoder.flush()
+        if data:
+            yield data
+
+def decompress(payload, method):
+    return b''.join(decompress_stream([payload], method))
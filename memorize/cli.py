@@ -0,0 +1,129 @@
+import os
+import sys
+import argparse
+from getpass import getpass
+
+# Only the standard library is imported up front: the storage modules pull
+# in SQLAlchemy and the cipher driver and are loaded once the arguments are
+# known, so --help and usage errors return at once. Qt is never imported.
+
+def password(args):
+    if args.password_file:
+        with open(args.password_file, 'rt') as file:
+            return file.readline().rstrip('\n')
+    return os.environ.get('MEMORIZE_PASSWORD') or getpass('Password: ')
+
+def progress(done, total):
+    print(f'\r{done}/{total}', end='', file=sys.stderr)
+
+def note_id(vault, note):
+    # Digits are an id if there is such a note, otherwise a name.
+    if note.isdigit() and vault.exists(int(note)):
+        return int(note)
+    ids = vault.find(note)
+    if not ids:
+        raise KeyError(note)
+    return ids[0]
+
+def list_notes(vault, args):
+    for id, name in vault.notes():
+        print(f'{id}\t{name}')
+
+def cat(vault, args):
+    sys.stdout.write(vault.read(note_id(vault, args.note)))
+
+def add(vault, args):
+    if args.file == '-':
+        content = sys.stdin.read()
+    elif args.file:
+        with open(args.file, 'rt', encoding='utf-8') as file:
+            content = file.read()
+    else:
+        content = ''
+    print(vault.add(args.name, content))
+
+def import_notes(vault, args):
+    from .importer import is_archive
+    if os.path.isdir(args.path) or is_archive(args.path):
+        result = vault.import_directory(args.path, progress, batch_size=args.batch_size, workers=args.workers)
+        print(file=sys.stderr)
+        for error in result.errors:
+            print(error, file=sys.stderr)
+        print(f'{result.imported} notes imported')
+    else:
+        print(vault.import_file(args.path))
+
+def export(vault, args):
+    if args.note is not None:
+        vault.export_note(note_id(vault, args.note), args.target)
+        return
+    result = vault.export(args.target, progress, batch_size=args.batch_size, workers=args.workers)
+    print(file=sys.stderr)
+    print(f'{result.exported} notes exported')
+
+def search(vault, args):
+    for hit in vault.search(args.query, args.limit):
+        print(f'{hit.document_id}\t{hit.name}\t{hit.kind}\t{hit.snippet}')
+
+def parser():
+    parser = argparse.ArgumentParser(prog='memorize', description='Work with a Memorize database without the GUI.')
+    parser.add_argument('database')
+    parser.add_argument('--password-file', help='read the password from the first line of this file '
+                                                '(default: $MEMORIZE_PASSWORD or a prompt)')
+    # Cipher settings must match the ones the database was written with,
+    # e.g. after it was repacked with other settings in the GUI.
+    parser.add_argument('--kdf-iter', type=int, help='PBKDF2 iterations the database was keyed with')
+    parser.add_argument('--cipher-page-size', type=int, help='page size the database was encrypted with')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('list', help='list notes')
+    command.set_defaults(run=list_notes, read_only=True)
+    command = commands.add_parser('cat', help='print a note by id or name')
+    command.add_argument('note')
+    command.set_defaults(run=cat, read_only=True)
+    command = commands.add_parser('add', help='add a note and print its id')
+    command.add_argument('name')
+    command.add_argument('file', nargs='?', help='read the content from this file, - for stdin')
+    command.set_defaults(run=add, read_only=False)
+    command = commands.add_parser('import', help='import a text file, or a directory or export archive of Markdown notes')
+    command.add_argument('path')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.add_argument('--workers', type=int, default=None)
+    command.set_defaults(run=import_notes, read_only=False)
+    command = commands.add_parser('export', help='export all notes to a directory, .zip or .tar.gz, or one note to a file')
+    command.add_argument('target')
+    command.add_argument('--note', help='export only this note, by id or name')
+    command.add_argument('--batch-size', type=int, default=200)
+    command.add_argument('--workers', type=int, default=None)
+    command.set_defaults(run=export, read_only=True)
+    command = commands.add_parser('search', help='full-text search')
+    command.add_argument('query')
+    command.add_argument('--limit', type=int, default=50)
+    command.set_defaults(run=search, read_only=True)
+    return parser
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    from sqlalchemy.exc import DatabaseError
+    from .storage import DEFAULT_PROFILE
+    from .vault import Vault
+    from .instrumentation import profiled, dump_profile
+    profile = DEFAULT_PROFILE._replace(kdf_iter=args.kdf_iter or DEFAULT_PROFILE.kdf_iter,
+                                       cipher_page_size=args.cipher_page_size or DEFAULT_PROFILE.cipher_page_size)
+    try:
+        with Vault(args.database, password(args), profile, read_only=args.read_only) as vault, profiled():
+            args.run(vault, args)
+    except KeyError as e:
+        print(f'no such note: {e.args[0]}', file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+    except DatabaseError as e:
+        print(f'cannot read {args.database}: {e.orig or e} (wrong password or cipher settings?)', file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        print('\ncancelled', file=sys.stderr)
+        return 1
+    finally:
+        dump_profile()
+    return 0
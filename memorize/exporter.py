@@ -0,0 +1,236 @@
+import io
+import os
+import os.path
+import re
+import json
+import posixpath
+import tarfile
+import zipfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from sqlalchemy import func, select
+from .models import Document, Text, Image, Attachment, DocumentText, DocumentImage, DocumentAttachment
+from .storage import image_extension, attachment_extension, attachment_chunks, read_blob
+
+MANIFEST = 'manifest.json'
+MANIFEST_VERSION = 3
+UNSAFE = re.compile(r'[<>:"\\|?*\x00-\x1f]')
+LINK = re.compile(r'(!?)\[[^\]]*\]\(\s*<?([^)>\s]+)>?')
+NOTE_SUFFIXES = ('.md', '.markdown')
+STREAM_SIZE = 8 << 20
+
+ExportResult = namedtuple('ExportResult', ['exported', 'cancelled'])
+
+class ChunkReader(io.RawIOBase):
+    # Read-only file object over an iterator of byte chunks.
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self.buffer:
+            self.buffer = next(self.chunks, None)
+            if self.buffer is None:
+                self.buffer = b''
+                return 0
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+class DirectoryWriter:
+    # Files are written by a small pool; at most `workers * 2` payloads are
+    # held in memory while waiting for a writer.
+    def __init__(self, root, workers=None):
+        workers = workers or min(8, (os.cpu_count() or 1) + 2)
+        self.root = root
+        self.executor = ThreadPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.futures = []
+
+    def write(self, name, data):
+        self.slots.acquire()
+        future = self.executor.submit(self.write_file, name, data)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def write_file(self, name, data):
+        path = os.path.join(self.root, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(data)
+
+    def write_stream(self, name, size, chunks):
+        # Chunks come from the database session, so they are written on
+        # the calling thread.
+        path = os.path.join(self.root, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+
+    def close(self):
+        self.executor.shutdown()
+        for future in self.futures:
+            future.result()
+
+class ZipWriter:
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+    def write(self, name, data):
+        with self.archive.open(name, 'w') as file:
+            file.write(data)
+
+    def write_stream(self, name, size, chunks):
+        with self.archive.open(name, 'w', force_zip64=size > zipfile.ZIP64_LIMIT) as file:
+            for chunk in chunks:
+                file.write(chunk)
+
+    def close(self):
+        self.archive.close()
+
+class TarWriter:
+    def __init__(self, path):
+        self.archive = tarfile.open(path, 'w:gz' if path.endswith(('.gz', '.tgz')) else 'w')
+
+    def write(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.archive.addfile(info, io.BytesIO(data))
+
+    def write_stream(self, name, size, chunks):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        self.archive.addfile(info, ChunkReader(chunks))
+
+    def close(self):
+        self.archive.close()
+
+def open_writer(target, workers=None):
+    if target.endswith('.zip'):
+        return ZipWriter(target)
+    if target.endswith(('.tar', '.tar.gz', '.tgz')):
+        return TarWriter(target)
+    return DirectoryWriter(target, workers)
+
+def local_target(target):
+    # The link targets the importer reads as files.
+    return not ('://' in target or target.startswith(('#', 'mailto:')) or target.lower().endswith(NOTE_SUFFIXES))
+
+def safe_name(name):
+    return UNSAFE.sub('_', name).strip(' .') or '_'
+
+def unique_path(base, extension, used):
+    path, number = base + extension, 1
+    while path.lower() in used:
+        number += 1
+        path = f'{base} ({number}){extension}'
+    used.add(path.lower())
+    return path
+
+def note_path(name, used):
+    return unique_path('notes/' + '/'.join(safe_name(part) for part in name.split('/')), '.md', used)
+
+def file_path(directory, name, extension, used):
+    stem, suffix = os.path.splitext(safe_name(os.path.basename(name.replace('\\', '/'))))
+    return unique_path(f'{directory}/{stem}', suffix or extension, used)
+
+def rewrite_links(content, path, files):
+    # files are the (name, file) pairs of the note's images and attachments
+    # in link order. The importer links the n-th distinct target with a
+    # given base name to the n-th file of that name, so links are matched
+    # back the same way and pointed at the exported files.
+    by_name, targets = {}, {}
+    for name, file in files:
+        by_name.setdefault(name, []).append(file)
+    directory = posixpath.dirname(path)
+
+    def replace(match):
+        target = unquote(match.group(2))
+        if not local_target(target):
+            return match.group(0)
+        if target not in targets:
+            candidates = by_name.get(posixpath.basename(target.replace('\\', '/')))
+            targets[target] = candidates.pop(0) if candidates else None
+        if targets[target] is None:
+            return match.group(0)
+        relative = posixpath.relpath(targets[target], directory)
+        relative = relative.replace('%', '%25').replace(' ', '%20').replace('(', '%28').replace(')', '%29')
+        start, end = match.start(2) - match.start(0), match.end(2) - match.start(0)
+        return match.group(0)[:start] + relative + match.group(0)[end:]
+    return LINK.sub(replace, content)
+
+def export_all(session, target, progress=None, cancelled=None, batch_size=200, workers=None):
+    total = session.scalar(select(func.count(Document.id)))
+    writer = open_writer(target, workers)
+    # Files are written once per blob and name, under that name with a
+    # number added when another file already has it.
+    notes, used, paths, exported = [], set(), {}, 0
+    try:
+        documents = session.execute(select(Document.id, Document.name).order_by(Document.id)
+                                    .execution_options(yield_per=batch_size))
+        for partition in documents.partitions():
+            if cancelled is not None and cancelled():
+                return ExportResult(exported, True)
+            ids = [document.id for document in partition]
+            texts, images, attachments = {}, {}, {}
+            for document_id, content in session.execute(
+                    select(DocumentText.document_id, Text.text).join(Text)
+                    .where(DocumentText.document_id.in_(ids)).order_by(DocumentText.id)):
+                texts.setdefault(document_id, []).append(content)
+            for document_id, image_id, name, format, size in session.execute(
+                    select(DocumentImage.document_id, Image.id, DocumentImage.name, Image.format,
+                           func.length(Image.image))
+                    .join(Image).where(DocumentImage.document_id.in_(ids)).order_by(DocumentImage.id)):
+                # Images may have been converted, so the format decides the extension.
+                extension = '.' + image_extension(format)
+                file_name = os.path.splitext(name)[0] + extension if name else f'image-{image_id}{extension}'
+                key = (Image, image_id, file_name)
+                images.setdefault(document_id, []).append((key, name))
+                if key in paths:
+                    continue
+                path = paths[key] = file_path('images', file_name, extension, used)
+                if size > STREAM_SIZE:
+                    writer.write_stream(path, size, read_blob(session, Image.image, image_id))
+                else:
+                    writer.write(path, session.scalar(select(Image.image).where(Image.id == image_id)))
+            for document_id, attachment_id, name, mime, size in session.execute(
+                    select(DocumentAttachment.document_id, Attachment.id, DocumentAttachment.name,
+                           DocumentAttachment.mime, Attachment.size).join(Attachment)
+                    .where(DocumentAttachment.document_id.in_(ids)).order_by(DocumentAttachment.id)):
+                extension = attachment_extension(name, mime)
+                file_name = name or f'attachment-{attachment_id}{extension}'
+                key = (Attachment, attachment_id, file_name)
+                attachments.setdefault(document_id, []).append((key, name))
+                if key in paths:
+                    continue
+                path = paths[key] = file_path('attachments', file_name, extension, used)
+                chunks = attachment_chunks(session, attachment_id)
+                if size > STREAM_SIZE:
+                    writer.write_stream(path, size, chunks)
+                else:
+                    writer.write(path, b''.join(chunks))
+            for document in partition:
+                note_images = [{'file': paths[key], 'name': name} for key, name in images.get(document.id, [])]
+                note_attachments = [{'file': paths[key], 'name': name}
+                                    for key, name in attachments.get(document.id, [])]
+                path = note_path(document.name, used)
+                content = rewrite_links(''.join(texts.get(document.id, [])), path,
+                                        [(file['name'], file['file']) for file in note_images + note_attachments])
+                writer.write(path, content.encode('utf-8'))
+                notes.append({'name': document.name, 'file': path,
+                              'images': note_images, 'attachments': note_attachments})
+            exported += len(partition)
+            if progress is not None:
+                progress(exported, total)
+        manifest = {'version': MANIFEST_VERSION, 'notes': notes}
+        writer.write(MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8'))
+    finally:
+        writer.close()
+    return ExportResult(exported, False)
@@ -0,0 +1,243 @@
+import os
+import os.path
+import json
+import tarfile
+import zipfile
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from mimetypes import guess_type
+from urllib.parse import unquote
+from sqlalchemy import func, insert, select
+from .models import blob_digest, Document, Text, Image, Attachment, DocumentText, DocumentImage, DocumentAttachment
+from .exporter import MANIFEST, LINK, NOTE_SUFFIXES, local_target
+from .search import attachment_body, index_attachments
+from .blobs import compress
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+NoteFile = namedtuple('NoteFile', ['name', 'content', 'images', 'attachments', 'errors'])
+ImageFile = namedtuple('ImageFile', ['data', 'format', 'digest', 'thumbnail', 'width', 'height', 'name'],
+                       defaults=[None, None, None, None])
+AttachmentFile = namedtuple('AttachmentFile', ['data', 'compression', 'size', 'name', 'mime', 'digest', 'body'])
+ImportResult = namedtuple('ImportResult', ['imported', 'errors', 'cancelled'])
+
+def attachment_file(data, name, mime):
+    mime = mime or 'application/octet-stream'
+    payload, compression = compress(data, mime)
+    return AttachmentFile(payload, compression, len(data), name, mime, blob_digest(data),
+                          attachment_body(payload, compression, mime))
+
+def image_row(image):
+    return {'image': image.data, 'format': image.format, 'digest': image.digest,
+            'thumbnail': image.thumbnail, 'width': image.width, 'height': image.height}
+
+def attachment_row(attachment):
+    return {'data': attachment.data, 'compression': attachment.compression, 'size': attachment.size,
+            'mime': attachment.mime, 'digest': attachment.digest}
+
+def image_link(document_id, image_id, image):
+    return {'document_id': document_id, 'image_id': image_id, 'name': image.name}
+
+def attachment_link(document_id, attachment_id, attachment):
+    return {'document_id': document_id, 'attachment_id': attachment_id,
+            'name': attachment.name, 'mime': attachment.mime}
+
+def is_archive(path):
+    return os.path.isfile(path) and path.lower().endswith(ARCHIVE_SUFFIXES)
+
+def extract_archive(path, directory):
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            archive.extractall(directory)
+    else:
+        with tarfile.open(path) as archive:
+            archive.extractall(directory, filter='data')
+
+def find_notes(root):
+    # A manifest written by exporter.export_all describes every note and
+    # its files exactly; otherwise notes are found by walking the tree.
+    manifest = os.path.join(root, MANIFEST)
+    if os.path.isfile(manifest):
+        with open(manifest, 'rt', encoding='utf-8') as file:
+            return [(os.path.join(root, *entry['file'].split('/')), entry) for entry in json.load(file)['notes']]
+    paths = []
+    for directory, directories, files in os.walk(root):
+        directories.sort()
+        paths.extend((os.path.join(directory, file), None) for file in sorted(files)
+                     if file.lower().endswith(NOTE_SUFFIXES))
+    return paths
+
+def manifest_files(root, entry):
+    # Version 1 manifests list attachment paths only, versions 1 and 2
+    # image paths only.
+    for image in entry['images']:
+        if isinstance(image, str):
+            image = {'file': image, 'name': None}
+        yield os.path.join(root, *image['file'].split('/')), True, image['name']
+    for attachment in entry['attachments']:
+        if isinstance(attachment, str):
+            attachment = {'file': attachment, 'name': None}
+        yield os.path.join(root, *attachment['file'].split('/')), False, attachment['name']
+
+def linked_files(path, content):
+    directory = os.path.dirname(path)
+    for match in LINK.finditer(content):
+        target = unquote(match.group(2))
+        if not local_target(target):
+            continue
+        # Missing targets are yielded too, so load_note reports them.
+        target = os.path.normpath(os.path.join(directory, target))
+        mime, _ = guess_type(target)
+        yield target, bool(match.group(1)) or (mime or '').startswith('image/'), None
+
+def check_inside(root, path):
+    # Manifests and links come with the files being imported, so they may
+    # not point outside the imported directory.
+    root, path = os.path.abspath(root), os.path.abspath(path)
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f'outside of {root}')
+
+def load_note(root, path, entry=None):
+    # Runs on the reader pool: everything that touches the disk or decodes
+    # data happens here, the database thread only inserts rows.
+    check_inside(root, path)
+    with open(path, 'rb') as file:
+        content = file.read().decode('utf-8', errors='replace')
+    if entry is not None:
+        name, files = entry['name'], manifest_files(root, entry)
+    else:
+        name, files = os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, '/'), linked_files(path, content)
+    images, attachments, errors, seen = [], [], [], set()
+    for target, is_image, original_name in files:
+        if target in seen:
+            continue
+        seen.add(target)
+        try:
+            check_inside(root, target)
+            with open(target, 'rb') as file:
+                data = file.read()
+        except (OSError, ValueError) as e:
+            errors.append(f'{target}: {e}')
+            continue
+        mime, _ = guess_type(original_name or target)
+        if is_image:
+            format = mime.split('/')[1] if mime else 'png'
+            images.append(ImageFile(data, format, blob_digest(data), name=original_name or os.path.basename(target)))
+        else:
+            attachments.append(attachment_file(data, original_name or os.path.basename(target), mime))
+    return NoteFile(name, content, images, attachments, errors)
+
+def next_id(session, model):
+    return (session.scalar(select(func.max(model.id))) or 0) + 1
+
+def store_blobs(session, model, blobs, make_row):
+    # Content-addressed like storage.store_image: blobs already in the
+    # database or seen earlier in the batch are only linked. Returns the
+    # ids by digest and the blobs that were inserted, by id.
+    ids = dict(session.execute(select(model.digest, model.id).where(
+        model.digest.in_({blob.digest for blob in blobs}))).all()) if blobs else {}
+    rows, created, id = [], {}, next_id(session, model)
+    for blob in blobs:
+        if blob.digest not in ids:
+            ids[blob.digest] = id
+            created[id] = blob
+            rows.append(dict(make_row(blob), id=id))
+            id += 1
+    if rows:
+        session.execute(insert(model), rows)
+    return ids, created
+
+def insert_notes(session, notes):
+    document_id, text_id = next_id(session, Document), next_id(session, Text)
+    documents, texts, document_texts = [], [], []
+    for index, note in enumerate(notes):
+        documents.append({'id': document_id + index, 'name': note.name})
+        texts.append({'id': text_id + index, 'text': note.content})
+        document_texts.append({'document_id': document_id + index, 'text_id': text_id + index})
+    if documents:
+        session.execute(insert(Document), documents)
+        session.execute(insert(Text), texts)
+        session.execute(insert(DocumentText), document_texts)
+    image_ids, _ = store_blobs(session, Image, [image for note in notes for image in note.images], image_row)
+    attachment_ids, created = store_blobs(
+        session, Attachment, [attachment for note in notes for attachment in note.attachments], attachment_row)
+    index_attachments(session.connection(), [(id, attachment.body) for id, attachment in created.items()])
+    document_images = [image_link(document_id + index, image_ids[image.digest], image)
+                       for index, note in enumerate(notes) for image in note.images]
+    document_attachments = [attachment_link(document_id + index, attachment_ids[attachment.digest], attachment)
+                            for index, note in enumerate(notes) for attachment in note.attachments]
+    if document_images:
+        session.execute(insert(DocumentImage), document_images)
+    if document_attachments:
+        session.execute(insert(DocumentAttachment), document_attachments)
+
+def import_directory(session, root, progress=None, cancelled=None, batch_size=500, workers=None):
+    if is_archive(root):
+        # A zip or tar export is unpacked to a temporary directory first.
+        with tempfile.TemporaryDirectory(prefix='memorize-import-') as directory:
+            extract_archive(root, directory)
+            return import_directory(session, directory, progress, cancelled, batch_size, workers)
+    paths = find_notes(root)
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    imported, errors = 0, []
+    with ThreadPoolExecutor(workers) as executor:
+        # The next batch is read while the current one is being inserted.
+        pending = [executor.submit(load_note, root, *note) for note in batches[0]] if batches else []
+        for number in range(len(batches)):
+            if cancelled is not None and cancelled():
+                for future in pending:
+                    future.cancel()
+                return ImportResult(imported, errors, True)
+            current = pending
+            pending = [executor.submit(load_note, root, *note) for note in batches[number + 1]] \
+                if number + 1 < len(batches) else []
+            notes = []
+            for (path, _), future in zip(batches[number], current):
+                try:
+                    notes.append(future.result())
+                except (OSError, ValueError) as e:
+                    errors.append(f'{path}: {e}')
+            for note in notes:
+                errors.extend(note.errors)
+            if notes:
+                insert_notes(session, notes)
+                session.commit()
+                imported += len(notes)
+            if progress is not None:
+                progress(imported, len(paths))
+    return ImportResult(imported, errors, False)
+
+def ingest_files(session, document_id, paths, read_file, progress=None, cancelled=None, workers=None):
+    # Files dropped on a note. read_file turns a path into an ImageFile or
+    # an AttachmentFile and runs on the pool; a file it fails on is
+    # reported and skipped. The rest is linked in a single transaction.
+    session.get_one(Document, document_id)
+    images, attachments, errors = [], [], []
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(read_file, path) for path in paths]
+        for done, (path, future) in enumerate(zip(paths, futures), 1):
+            if cancelled is not None and cancelled():
+                for future in futures:
+                    future.cancel()
+                return ImportResult(0, errors, True)
+            try:
+                blob = future.result()
+            except (OSError, ValueError) as e:
+                errors.append(f'{path}: {e}')
+            else:
+                (images if isinstance(blob, ImageFile) else attachments).append(blob)
+            if progress is not None:
+                progress(done, len(paths))
+    image_ids, _ = store_blobs(session, Image, images, image_row)
+    attachment_ids, created = store_blobs(session, Attachment, attachments, attachment_row)
+    index_attachments(session.connection(), [(id, attachment.body) for id, attachment in created.items()])
+    if images:
+        session.execute(insert(DocumentImage), [image_link(document_id, image_ids[image.digest], image)
+                                                for image in images])
+    if attachments:
+        session.execute(insert(DocumentAttachment), [
+            attachment_link(document_id, attachment_ids[attachment.digest], attachment)
+            for attachment in attachments])
+    session.commit()
+    return ImportResult(len(images) + len(attachments), errors, False)
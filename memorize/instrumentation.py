@@ -0,0 +1,190 @@
+import os
+import re
+import time
+import threading
+import cProfile
+import pstats
+from collections import namedtuple
+from contextlib import contextmanager
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+from .models import Document, Text, Image, Attachment, Revision
+
+# Counters for the statements every engine runs and for named timers
+# around user actions. Statements are charged to the innermost timer
+# running on their thread, which for the GUI is the database job.
+#
+# MEMORIZE_TRACE=<file> appends a line per statement and timer to file.
+# MEMORIZE_PROFILE=<file> profiles every thread that runs under
+# profiled() and writes the merged cProfile stats to file on exit.
+
+TRACE = os.environ.get('MEMORIZE_TRACE')
+PROFILE = os.environ.get('MEMORIZE_PROFILE')
+PLACEHOLDERS = re.compile(r'\(\?(?:, \?)+\)')
+SPACES = re.compile(r'\s+')
+
+Timing = namedtuple('Timing', ['name', 'count', 'total', 'max', 'queries'])
+CacheRate = namedtuple('CacheRate', ['name', 'hits', 'misses'])
+
+def normalize(statement):
+    # Expanded IN lists differ in length only; count them as one statement.
+    return PLACEHOLDERS.sub('(?, …)', SPACES.sub(' ', statement).strip())
+
+class Statistics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.trace = open(TRACE, 'at', buffering=1) if TRACE else None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.statements, self.actions, self.caches = {}, {}, {}
+
+    def write_trace(self, kind, name, elapsed):
+        thread = threading.current_thread().name
+        with self.lock:
+            self.trace.write(f'{time.time():.6f}\t{thread}\t{kind}\t{elapsed * 1000:.3f}\t{name}\n')
+
+    def add(self, table, name, elapsed, queries=0):
+        timing = table.setdefault(name, [0, 0.0, 0.0, 0])
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
+        timing[3] += queries
+
+    def record_statement(self, statement, elapsed, cache_hit):
+        statement = normalize(statement)
+        with self.lock:
+            self.add(self.statements, statement, elapsed)
+            if cache_hit in (CACHE_HIT, CACHE_MISS):
+                self.count_locked('statement cache', cache_hit is CACHE_HIT)
+        actions = getattr(self.local, 'actions', None)
+        if actions:
+            actions[-1][1] += 1
+        if self.trace is not None:
+            self.write_trace('sql', statement, elapsed)
+
+    def count_locked(self, cache, hit):
+        rate = self.caches.setdefault(cache, [0, 0])
+        rate[0 if hit else 1] += 1
+
+    def count(self, cache, hit):
+        with self.lock:
+            self.count_locked(cache, hit)
+
+    @contextmanager
+    def timer(self, name):
+        actions = self.local.__dict__.setdefault('actions', [])
+        actions.append([name, 0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            _, queries = actions.pop()
+            with self.lock:
+                self.add(self.actions, name, elapsed, queries)
+            if self.trace is not None:
+                self.write_trace('timer', name, elapsed)
+
+    def slowest_statements(self, limit=20):
+        with self.lock:
+            timings = [Timing(name, *timing) for name, timing in self.statements.items()]
+        return sorted(timings, key=lambda timing: timing.total, reverse=True)[:limit]
+
+    def action_timings(self):
+        with self.lock:
+            timings = [Timing(name, *timing) for name, timing in self.actions.items()]
+        return sorted(timings, key=lambda timing: timing.total, reverse=True)
+
+    def cache_rates(self):
+        with self.lock:
+            return [CacheRate(name, *rate) for name, rate in sorted(self.caches.items())]
+
+STATISTICS = Statistics()
+timer = STATISTICS.timer
+count = STATISTICS.count
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info['query_start'].pop()
+    STATISTICS.record_statement(statement, elapsed, getattr(context, 'cache_hit', None))
+
+def enable():
+    # Listens on the Engine class, so it covers every engine opened later.
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+profiles = {}
+
+@contextmanager
+def profiled():
+    if not PROFILE:
+        yield
+        return
+    profile = profiles.setdefault(threading.get_ident(), cProfile.Profile())
+    try:
+        profile.enable()
+    except ValueError:
+        # Since Python 3.12 a profiler is process-wide and only one can be
+        # active; the one already running records this thread too.
+        if not profile.getstats():
+            del profiles[threading.get_ident()]
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+
+def dump_profile():
+    if PROFILE and profiles:
+        stats = None
+        for profile in profiles.values():
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        stats.dump_stats(PROFILE)
+
+def database_statistics(session):
+    connection = session.connection()
+    pragma = lambda name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+    page_size, page_count, freelist_count = pragma('page_size'), pragma('page_count'), pragma('freelist_count')
+    path = connection.engine.url.database
+    statistics = {
+        'file size': os.path.getsize(path),
+        'wal size': os.path.getsize(path + '-wal') if os.path.exists(path + '-wal') else 0,
+        'page size': page_size,
+        'pages': page_count,
+        'free pages': freelist_count,
+        'free space': page_size * freelist_count,
+        'cache size': pragma('cache_size'),
+        'journal mode': pragma('journal_mode'),
+        'mmap size': pragma('mmap_size'),
+        'schema version': pragma('user_version'),
+    }
+    for model in (Document, Text, Image, Attachment, Revision):
+        statistics[model.__tablename__] = session.scalar(select(func.count()).select_from(model))
+    return statistics
+
+def report(statistics=STATISTICS, database=None):
+    lines = ['Actions', f'{"count":>7} {"total ms":>10} {"max ms":>9} {"queries":>8}  name']
+    for timing in statistics.action_timings():
+        lines.append(f'{timing.count:7} {timing.total * 1000:10.1f} {timing.max * 1000:9.1f} {timing.queries:8}  {timing.name}')
+    lines += ['', 'Slowest statements', f'{"count":>7} {"total ms":>10} {"max ms":>9}  statement']
+    for timing in statistics.slowest_statements():
+        lines.append(f'{timing.count:7} {timing.total * 1000:10.1f} {timing.max * 1000:9.1f}  {timing.name[:300]}')
+    lines += ['', 'Caches']
+    for rate in statistics.cache_rates():
+        total = rate.hits + rate.misses
+        lines.append(f'{rate.name}: {rate.hits}/{total} hits ({rate.hits / total:.0%})' if total else f'{rate.name}: -')
+    if database:
+        lines += ['', 'Database']
+        lines += [f'{name}: {value}' for name, value in database.items()]
+    return '\n'.join(lines)
@@ -0,0 +1,76 @@
+import os.path
+import time
+import hashlib
+from functools import lru_cache
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DatabaseError
+from sqlalchemy.pool import NullPool
+from .storage import DEFAULT_PROFILE, engine_url, open_engine
+
+# SQLCipher derives the page key from the password and the salt in the
+# first 16 bytes of the file with PBKDF2, which is what makes opening a
+# database slow. Deriving it here once and passing it as a raw key
+# (x'<key><salt>') lets every later connection skip the KDF: the reader
+# connections, and reopening the vault while its key is cached.
+
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+@lru_cache(maxsize=None)
+def kdf_algorithm():
+    # SQLCipher 4 uses PBKDF2-HMAC-SHA512 by default, older versions SHA1.
+    engine = create_engine(engine_url(':memory:', '', DEFAULT_PROFILE), poolclass=NullPool)
+    with engine.connect() as connection:
+        result = connection.exec_driver_sql("PRAGMA cipher_version")
+        version = result.scalar() if result.returns_rows else None
+    engine.dispose()
+    return 'sha1' if version and int(version.split('.')[0]) < 4 else 'sha512'
+
+def read_salt(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as file:
+        salt = file.read(SALT_SIZE)
+    return salt if len(salt) == SALT_SIZE else None
+
+def derive_key(password, salt, profile=DEFAULT_PROFILE):
+    key = hashlib.pbkdf2_hmac(kdf_algorithm(), password.encode('utf-8'), salt, int(profile.kdf_iter), KEY_SIZE)
+    return f"x'{key.hex()}{salt.hex()}'"
+
+def unlock(path, password, profile=DEFAULT_PROFILE):
+    # Opens the writable engine and returns it with the raw key it was
+    # opened with, or None when SQLCipher had to derive the key itself:
+    # new files, and builds with other KDF settings than the defaults.
+    salt = read_salt(path)
+    if salt is not None:
+        key = derive_key(password, salt, profile)
+        try:
+            return open_engine(path, key, profile=profile), key
+        except DatabaseError:
+            pass
+    return open_engine(path, password, profile=profile), None
+
+class KeyCache:
+    # Raw keys by database path, forgotten ttl seconds after they were
+    # cached. A ttl of 0 disables the cache.
+    def __init__(self, ttl=15 * 60):
+        self.ttl = ttl
+        self.keys = {}
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        key, expires = self.keys.get(path, (None, 0))
+        if key is not None and time.monotonic() >= expires:
+            del self.keys[path]
+            return None
+        return key
+
+    def put(self, path, key):
+        if self.ttl > 0 and key is not None:
+            self.keys[os.path.abspath(path)] = (key, time.monotonic() + self.ttl)
+
+    def forget(self, path):
+        self.keys.pop(os.path.abspath(path), None)
+
+    def clear(self):
+        self.keys.clear()
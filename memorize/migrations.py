@@ -0,0 +1,186 @@
+from types import GeneratorType
+from sqlalchemy import inspect, text
+from .models import Base, blob_digest
+from .blobs import compress
+
+# The schema version is kept in PRAGMA user_version, which lives in the
+# (encrypted) database header and changes together with the transaction
+# that applied a migration. New databases are created from the models at
+# the latest version; older ones run every migration after their version.
+# A migration that touches many rows is a generator: every yield commits
+# the batch done so far, and the version is only bumped after the last
+# one, so such migrations must be safe to run again from the start.
+
+BATCH_SIZE = 1000
+
+def add_column(connection, table, column, definition):
+    if column not in {c['name'] for c in inspect(connection).get_columns(table)}:
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+
+def fold_duplicates(connection, table, column, link_table, link_column, encode, batch_size=BATCH_SIZE):
+    keepers = dict((digest, id) for id, digest in connection.execute(
+        text(f"SELECT id, digest FROM {table} WHERE digest IS NOT NULL")))
+    while True:
+        # Every row of a batch either gets its digest or is deleted, so the
+        # next query starts where this one stopped.
+        rows = connection.execute(text(f"SELECT id, {column} FROM {table} WHERE digest IS NULL "
+                                       f"ORDER BY id LIMIT {int(batch_size)}")).all()
+        if not rows:
+            return
+        digests, duplicates = [], []
+        for id, value in rows:
+            digest = blob_digest(encode(value))
+            if digest in keepers:
+                duplicates.append({'id': id, 'keeper': keepers[digest]})
+            else:
+                keepers[digest] = id
+                digests.append({'id': id, 'digest': digest})
+        if duplicates:
+            connection.execute(text(f"UPDATE {link_table} SET {link_column} = :keeper WHERE {link_column} = :id"),
+                               duplicates)
+            connection.execute(text(f"DELETE FROM {table} WHERE id = :id"), duplicates)
+        if digests:
+            connection.execute(text(f"UPDATE {table} SET digest = :digest WHERE id = :id"), digests)
+        yield
+
+def content_addressed_blobs(connection):
+    add_column(connection, 'images', 'digest', 'VARCHAR(64)')
+    add_column(connection, 'attachments', 'digest', 'VARCHAR(64)')
+    yield from fold_duplicates(connection, 'images', 'image', 'document_images', 'image_id', bytes)
+    yield from fold_duplicates(connection, 'attachments', 'text', 'document_attachments', 'attachment_id',
+                               lambda value: value.encode('utf-8'))
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_images_digest ON images (digest)"))
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_attachments_digest ON attachments (digest)"))
+
+def image_thumbnails(connection):
+    # Thumbnails need Qt to render, so existing images get theirs the
+    # first time the GUI lists them.
+    add_column(connection, 'images', 'format', "VARCHAR(16) DEFAULT 'png' NOT NULL")
+    add_column(connection, 'images', 'width', 'INTEGER')
+    add_column(connection, 'images', 'height', 'INTEGER')
+    add_column(connection, 'images', 'thumbnail', 'BLOB')
+
+def document_name_index(connection):
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_documents_name ON documents (name)"))
+
+def foreign_key_indexes(connection):
+    # Index names follow the naming convention in models.Base, so a fresh
+    # database created from the models ends up with the same names.
+    for table, column in [('document_texts', 'document_id'), ('document_texts', 'text_id'),
+                          ('document_images', 'document_id'), ('document_images', 'image_id'),
+                          ('document_attachments', 'document_id'), ('document_attachments', 'attachment_id')]:
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})"))
+        yield
+
+LINK_TABLE = """CREATE TABLE {table} (
+	id INTEGER NOT NULL, 
+	document_id INTEGER NOT NULL, 
+	{column} INTEGER NOT NULL, 
+	CONSTRAINT pk_{table} PRIMARY KEY (id), 
+	CONSTRAINT fk_{table}_document_id_documents FOREIGN KEY(document_id) REFERENCES documents (id) ON DELETE CASCADE, 
+	CONSTRAINT fk_{table}_{column}_{target} FOREIGN KEY({column}) REFERENCES {target} (id) ON DELETE CASCADE
+)"""
+
+def cascading_links(connection):
+    # SQLite cannot alter a foreign key, so every link table is rebuilt
+    # with ON DELETE CASCADE. Links to rows that no longer exist are
+    # dropped on the way, otherwise the foreign keys could not be enforced.
+    connection.execute(text("PRAGMA foreign_keys = OFF"))
+    for table, column, target in [('document_texts', 'text_id', 'texts'),
+                                  ('document_images', 'image_id', 'images'),
+                                  ('document_attachments', 'attachment_id', 'attachments')]:
+        connection.execute(text(f"DROP INDEX IF EXISTS ix_{table}_document_id"))
+        connection.execute(text(f"DROP INDEX IF EXISTS ix_{table}_{column}"))
+        # DDL is not rolled back with the batch: if an earlier run stopped
+        # after the rename, the rows are still in {table}_old and {table}
+        # is a partial copy, so the copy starts over from {table}_old.
+        if inspect(connection).has_table(f'{table}_old'):
+            connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        else:
+            connection.execute(text(f"ALTER TABLE {table} RENAME TO {table}_old"))
+        connection.execute(text(LINK_TABLE.format(table=table, column=column, target=target)))
+        connection.execute(text(f"INSERT INTO {table} (id, document_id, {column}) "
+                                f"SELECT id, document_id, {column} FROM {table}_old "
+                                f"WHERE document_id IN (SELECT id FROM documents) "
+                                f"AND {column} IN (SELECT id FROM {target})"))
+        connection.execute(text(f"DROP TABLE {table}_old"))
+        connection.execute(text(f"CREATE INDEX ix_{table}_document_id ON {table} (document_id)"))
+        connection.execute(text(f"CREATE INDEX ix_{table}_{column} ON {table} ({column})"))
+        yield
+    connection.execute(text("PRAGMA foreign_keys = ON"))
+
+def binary_attachments(connection):
+    # Attachments become raw, possibly compressed bytes. They can no longer
+    # be indexed by a trigger, but their existing index entries stay valid.
+    connection.execute(text("DROP TRIGGER IF EXISTS search_attachments_insert"))
+    connection.execute(text("DROP TRIGGER IF EXISTS search_attachments_update"))
+    add_column(connection, 'attachments', 'data', 'BLOB')
+    add_column(connection, 'attachments', 'name', 'VARCHAR(255)')
+    add_column(connection, 'attachments', 'mime', "VARCHAR(127) DEFAULT 'application/octet-stream' NOT NULL")
+    add_column(connection, 'attachments', 'size', "INTEGER DEFAULT '0' NOT NULL")
+    add_column(connection, 'attachments', 'compression', "VARCHAR(8) DEFAULT '' NOT NULL")
+    if 'text' not in {c['name'] for c in inspect(connection).get_columns('attachments')}:
+        return
+    while True:
+        rows = connection.execute(text(f"SELECT id, text FROM attachments WHERE data IS NULL "
+                                       f"ORDER BY id LIMIT {BATCH_SIZE}")).all()
+        if not rows:
+            break
+        updates = []
+        for id, value in rows:
+            data = value.encode('utf-8')
+            payload, compression = compress(data, 'text/plain')
+            updates.append({'id': id, 'data': payload, 'size': len(data), 'compression': compression})
+        connection.execute(text("UPDATE attachments SET data = :data, size = :size, compression = :compression, "
+                                "mime = 'text/plain' WHERE id = :id"), updates)
+        yield
+    connection.execute(text("ALTER TABLE attachments DROP COLUMN text"))
+
+def attachment_link_names(connection):
+    # Names and types move from the shared blob to each link to it.
+    add_column(connection, 'document_attachments', 'name', 'VARCHAR(255)')
+    add_column(connection, 'document_attachments', 'mime',
+               "VARCHAR(127) DEFAULT 'application/octet-stream' NOT NULL")
+    if 'name' not in {c['name'] for c in inspect(connection).get_columns('attachments')}:
+        return
+    connection.execute(text("UPDATE document_attachments SET "
+                            "name = (SELECT name FROM attachments WHERE attachments.id = attachment_id), "
+                            "mime = (SELECT mime FROM attachments WHERE attachments.id = attachment_id)"))
+    connection.execute(text("ALTER TABLE attachments DROP COLUMN name"))
+
+def image_link_names(connection):
+    add_column(connection, 'document_images', 'name', 'VARCHAR(255)')
+
+MIGRATIONS = [
+    content_addressed_blobs,
+    image_thumbnails,
+    document_name_index,
+    foreign_key_indexes,
+    cascading_links,
+    binary_attachments,
+    attachment_link_names,
+    image_link_names,
+]
+
+def schema_version(connection):
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+def set_schema_version(connection, version):
+    connection.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+def upgrade(engine):
+    with engine.begin() as connection:
+        if not inspect(connection).has_table('documents'):
+            Base.metadata.create_all(bind=connection)
+            set_schema_version(connection, len(MIGRATIONS))
+            return
+        version = schema_version(connection)
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with engine.connect() as connection:
+            batches = migration(connection)
+            if isinstance(batches, GeneratorType):
+                for _ in batches:
+                    connection.commit()
+            set_schema_version(connection, number)
+            connection.commit()
+    Base.metadata.create_all(bind=engine)
@@ -5,6 +5,10 @@ from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy import String, ForeignKey, DateTime, Text, Integer, MetaData, LargeBinary
 from sqlalchemy.types import UnicodeText
 from datetime import datetime
+from hashlib import sha256
+
+def blob_digest(data: bytes) -> str:
+    return sha256(data).hexdigest()
 
 class Base(DeclarativeBase):
     metadata = MetaData(naming_convention={
@@ -18,28 +22,28 @@ class Base(DeclarativeBase):
 class Document(Base):
     __tablename__ = 'documents'
     id: Mapped[int] = mapped_column(Integer(), primary_key=True)
-    name: Mapped[str] = mapped_column(String(64))
+    name: Mapped[str] = mapped_column(String(64), index=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(), server_default=sa.sql.func.now())
     updated_at: Mapped[datetime] = mapped_column(DateTime(), server_default=sa.sql.func.now())
 
-    document_texts: Mapped[List["DocumentText"]] = relationship(back_populates='document')
-    document_images: Mapped[List["DocumentImage"]] = relationship(back_populates='document')
-    document_attachments: Mapped[List["DocumentAttachment"]] = relationship(back_populates='document')
+    document_texts: Mapped[List["DocumentText"]] = relationship(back_populates='document', passive_deletes=True)
+    document_images: Mapped[List["DocumentImage"]] = relationship(back_populates='document', passive_deletes=True)
+    document_attachments: Mapped[List["DocumentAttachment"]] = relationship(back_populates='document', passive_deletes=True)
 
 class Text(Base):
     __tablename__ = 'texts'
     id: Mapped[int] = mapped_column(Integer(), primary_key=True)
-    text: Mapped[str] = mapped_column(UnicodeText())
+    text: Mapped[str] = mapped_column(UnicodeText(), deferred=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(), server_default=sa.sql.func.now())
     updated_at: Mapped[datetime] = mapped_column(DateTime(), server_default=sa.sql.func.now())
 
-    document_text: Mapped["DocumentText"] = relationship(back_populates='text')
+    document_text: Mapped["DocumentText"] = relationship(back_populates='text', passive_deletes=True)
 
 class DocumentText(Base):
     __tablename__ = 'document_texts'
     id: Mapped[int] = mapped_column(Integer(), primary_key=True)
-    document_id: Mapped[int] = mapped_column(ForeignKey('documents.id'))
-    text_id: Mapped[int] = mapped_column(ForeignKey('texts.id'))
+    document_id: Mapped[int] = mapped_column(ForeignKey('documents.id', ondelete='CASCADE'), index=True)
+    text_id: Mapped[int] = mapped_column(ForeignKey('texts.id', ondelete='CASCADE'), index=True)
 
     document: Mapped["Document"] = relationship(back_populates='document_texts')
     text: Mapped["Text"] = relationship(back_populates='document_text')
@@ -47,33 +51,61 @@ class DocumentText(Base):
 class DocumentImage(Base):
     __tablename__ = 'document_images'
     id: Mapped[int] = mapped_column(Integer(), primary_key=True)
-    document_id: Mapped[int] = mapped_column(ForeignKey('documents.id'))
-    image_id: Mapped[int] = mapped_column(ForeignKey('images.id'))
+    document_id: Mapped[int] = mapped_column(ForeignKey('documents.id', ondelete='CASCADE'), index=True)
+    image_id: Mapped[int] = mapped_column(ForeignKey('images.id', ondelete='CASCADE'), index=True)
+    name: Mapped[Optional[str]] = mapped_column(String(255))
 
     document: Mapped["Document"] = relationship(back_populates='document_images')
-    image: Mapped["Image"] = relationship(back_populates='document_image')
+    image: Mapped["Image"] = relationship(back_populates='document_images')
 
 class DocumentAttachment(Base):
     __tablename__ = 'document_attachments'
     id: Mapped[int] = mapped_column(Integer(), primary_key=True)
-    document_id: Mapped[int] = mapped_column(ForeignKey('documents.id'))
-    attachment_id: Mapped[int] = mapped_column(ForeignKey('attachments.id'))
+    document_id: Mapped[int] = mapped_column(ForeignKey('documents.id', ondelete='CASCADE'), index=True)
+    attachment_id: Mapped[int] = mapped_column(ForeignKey('attachments.id', ondelete='CASCADE'), index=True)
+    # The same bytes can be attached under different names, so the file
+    # name and type belong to the link, not to the content-addressed blob.
+    name: Mapped[Optional[str]] = mapped_column(String(255))
+    mime: Mapped[str] = mapped_column(String(127), default='application/octet-stream',
+                                      server_default='application/octet-stream')
 
     document: Mapped["Document"] = relationship(back_populates='document_attachments')
-    attachment: Mapped["Attachment"] = relationship(back_populates='document_attachment')
+    attachment: Mapped["Attachment"] = relationship(back_populates='document_attachments')
 
 class Image(Base):
     __tablename__ = 'images'
     id: Mapped[int] = mapped_column(Integer(), primary_key=True)
-    image: Mapped[bytearray] = mapped_column(LargeBinary())
+    image: Mapped[bytearray] = mapped_column(LargeBinary(), deferred=True)
+    digest: Mapped[Optional[str]] = mapped_column(String(64), unique=True, index=True)
+    format: Mapped[str] = mapped_column(String(16), default='png', server_default='png')
+    width: Mapped[Optional[int]] = mapped_column(Integer())
+    height: Mapped[Optional[int]] = mapped_column(Integer())
+    thumbnail: Mapped[Optional[bytes]] = mapped_column(LargeBinary())
     created_at: Mapped[datetime] = mapped_column(DateTime(), server_default=sa.sql.func.now())
 
-    document_image: Mapped["DocumentImage"] = relationship(back_populates='image')
+    document_images: Mapped[List["DocumentImage"]] = relationship(back_populates='image', passive_deletes=True)
 
 class Attachment(Base):
     __tablename__ = 'attachments'
     id: Mapped[int] = mapped_column(Integer(), primary_key=True)
-    text: Mapped[str] = mapped_column(UnicodeText())
+    data: Mapped[bytes] = mapped_column(LargeBinary(), deferred=True)
+    # The type the payload was compressed and indexed as.
+    mime: Mapped[str] = mapped_column(String(127), default='application/octet-stream',
+                                      server_default='application/octet-stream')
+    size: Mapped[int] = mapped_column(Integer(), default=0, server_default='0')
+    compression: Mapped[str] = mapped_column(String(8), default='', server_default='')
+    digest: Mapped[Optional[str]] = mapped_column(String(64), unique=True, index=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(), server_default=sa.sql.func.now())
 
-    document_attachment: Mapped["DocumentAttachment"] = relationship(back_populates='attachment')
+    document_attachments: Mapped[List["DocumentAttachment"]] = relationship(back_populates='attachment', passive_deletes=True)
+
+class Revision(Base):
+    __tablename__ = 'revisions'
+    __table_args__ = (sa.UniqueConstraint('document_id', 'number'),)
+    id: Mapped[int] = mapped_column(Integer(), primary_key=True)
+    document_id: Mapped[int] = mapped_column(ForeignKey('documents.id', ondelete='CASCADE'))
+    number: Mapped[int] = mapped_column(Integer())
+    depth: Mapped[int] = mapped_column(Integer())
+    size: Mapped[int] = mapped_column(Integer())
+    data: Mapped[bytes] = mapped_column(LargeBinary(), deferred=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(), server_default=sa.sql.func.now())
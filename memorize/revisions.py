@@ -0,0 +1,148 @@
+import json
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from difflib import SequenceMatcher
+from sqlalchemy import delete, func, insert, select
+from .models import Revision
+
+# Every save of a note appends a revision. A revision is either a keyframe
+# holding the whole text or a line delta against the revision before it;
+# depth counts the deltas since the last keyframe, so any revision is
+# rebuilt from one keyframe and at most keyframe_interval - 1 deltas.
+# Payloads are zlib-compressed JSON.
+
+RevisionItem = namedtuple('RevisionItem', ['number', 'created_at', 'size'])
+RetentionPolicy = namedtuple('RetentionPolicy', ['keyframe_interval', 'keep_recent', 'keep_days'],
+                             defaults=[20, 50, 90])
+DEFAULT_RETENTION = RetentionPolicy()
+
+def encode_delta(old, new):
+    old_lines, new_lines = old.splitlines(keepends=True), new.splitlines(keepends=True)
+    operations = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            operations.append(i2 - i1)
+            continue
+        if i2 > i1:
+            operations.append(i1 - i2)
+        if j2 > j1:
+            operations.append(new_lines[j1:j2])
+    return operations
+
+def apply_delta(old, operations):
+    # Positive numbers copy lines, negative ones skip them and lists are
+    # inserted as they are.
+    old_lines, position, lines = old.splitlines(keepends=True), 0, []
+    for operation in operations:
+        if isinstance(operation, list):
+            lines.extend(operation)
+        elif operation > 0:
+            lines.extend(old_lines[position:position + operation])
+            position += operation
+        else:
+            position -= operation
+    return ''.join(lines)
+
+def pack(value):
+    return zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+def unpack(data):
+    return json.loads(zlib.decompress(data))
+
+def revision_row(document_id, number, text, previous=None, depth=0, created_at=None, policy=DEFAULT_RETENTION):
+    if previous is None or depth >= policy.keyframe_interval:
+        depth, data = 0, pack(text)
+    else:
+        data = pack(encode_delta(previous, text))
+    row = {'document_id': document_id, 'number': number, 'depth': depth, 'size': len(text), 'data': data}
+    if created_at is not None:
+        row['created_at'] = created_at
+    return row
+
+def latest_revisions(session, document_ids):
+    latest = select(Revision.document_id, func.max(Revision.number).label('number')).where(
+        Revision.document_id.in_(document_ids)).group_by(Revision.document_id).subquery()
+    return {document_id: (number, depth) for document_id, number, depth in session.execute(
+        select(Revision.document_id, Revision.number, Revision.depth).join(
+            latest, (Revision.document_id == latest.c.document_id) & (Revision.number == latest.c.number)))}
+
+def check_policy(policy):
+    if policy.keep_recent <= 0:
+        raise ValueError(f'keep_recent must be positive, not {policy.keep_recent}')
+
+def add_revisions(session, changes, policy=DEFAULT_RETENTION):
+    # changes maps a document id to its (previous, new) text. The previous
+    # text is what the latest revision holds, so deltas are taken against
+    # it; a note saved for the first time gets it as a keyframe first.
+    check_policy(policy)
+    latest = latest_revisions(session, list(changes))
+    rows, compact = [], []
+    for document_id, (previous, text) in changes.items():
+        if previous == text:
+            continue
+        number, depth = latest.get(document_id, (0, None))
+        if depth is None:
+            rows.append(revision_row(document_id, 1, previous, policy=policy))
+            number, depth = 1, 0
+        rows.append(revision_row(document_id, number + 1, text, previous, depth + 1, policy=policy))
+        if (number + 1) % policy.keep_recent == 0:
+            compact.append(document_id)
+    if rows:
+        session.execute(insert(Revision), rows)
+    for document_id in compact:
+        compact_revisions(session, document_id, policy)
+
+def list_revisions(session, document_id):
+    return [RevisionItem(*row) for row in session.execute(
+        select(Revision.number, Revision.created_at, Revision.size)
+        .where(Revision.document_id == document_id).order_by(Revision.number.desc()))]
+
+def revision_text(session, document_id, number):
+    keyframe = select(func.max(Revision.number)).where(
+        Revision.document_id == document_id, Revision.number <= number, Revision.depth == 0).scalar_subquery()
+    text = None
+    for depth, data in session.execute(
+            select(Revision.depth, Revision.data).where(
+                Revision.document_id == document_id, Revision.number >= keyframe, Revision.number <= number)
+            .order_by(Revision.number)):
+        text = unpack(data) if depth == 0 else apply_delta(text, unpack(data))
+    return text
+
+def local_time(created_at):
+    # created_at comes from CURRENT_TIMESTAMP, which is naive UTC.
+    return created_at.replace(tzinfo=timezone.utc).astimezone()
+
+def retained(revisions, policy, now=None):
+    # The newest keep_recent revisions are kept, then the last one of every
+    # local day for keep_days days; the very first revision is always kept.
+    check_policy(policy)
+    now = now or datetime.now(timezone.utc)
+    keep, days = {revisions[0].number}, set()
+    for index, revision in enumerate(reversed(revisions)):
+        created_at = local_time(revision.created_at)
+        if index < policy.keep_recent:
+            keep.add(revision.number)
+        elif created_at >= now - timedelta(days=policy.keep_days) and created_at.date() not in days:
+            keep.add(revision.number)
+        days.add(created_at.date())
+    return keep
+
+def compact_revisions(session, document_id, policy=DEFAULT_RETENTION):
+    revisions = list(reversed(list_revisions(session, document_id)))
+    keep = retained(revisions, policy)
+    if len(keep) == len(revisions):
+        return
+    # Dropping a revision breaks the delta chain after it, so the kept ones
+    # are rebuilt in order and encoded again against each other.
+    rows, text, previous, depth = [], None, None, 0
+    for revision, (row_depth, data) in zip(revisions, session.execute(
+            select(Revision.depth, Revision.data).where(Revision.document_id == document_id)
+            .order_by(Revision.number))):
+        text = unpack(data) if row_depth == 0 else apply_delta(text, unpack(data))
+        if revision.number in keep:
+            rows.append(revision_row(document_id, revision.number, text, previous, depth + 1 if previous is not None
+                                     else 0, revision.created_at, policy))
+            depth, previous = rows[-1]['depth'], text
+    session.execute(delete(Revision).where(Revision.document_id == document_id))
+    session.execute(insert(Revision), rows)
@@ -0,0 +1,84 @@
+from collections import namedtuple
+from sqlalchemy import select, text
+from .models import Attachment
+from .blobs import decompress, is_text
+
+# Texts and attachments share one FTS5 table inside the (encrypted) database.
+# Rows are keyed by rowid: texts.id * 2 for texts, attachments.id * 2 + 1 for
+# attachments, so triggers can update and delete entries without a scan.
+# Attachment payloads are compressed, so they are added to the index by
+# index_attachments when they are stored rather than by a trigger.
+TEXT, ATTACHMENT = 0, 1
+
+SCHEMA = [
+    "CREATE VIRTUAL TABLE search_index USING fts5(body, tokenize='unicode61 remove_diacritics 2')",
+    """CREATE TRIGGER search_texts_insert AFTER INSERT ON texts BEGIN
+        INSERT INTO search_index(rowid, body) VALUES (new.id * 2, new.text);
+    END""",
+    """CREATE TRIGGER search_texts_update AFTER UPDATE OF text ON texts BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+        INSERT INTO search_index(rowid, body) VALUES (new.id * 2, new.text);
+    END""",
+    """CREATE TRIGGER search_texts_delete AFTER DELETE ON texts BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+    END""",
+    """CREATE TRIGGER search_attachments_delete AFTER DELETE ON attachments BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+    END""",
+]
+
+SEARCH = text("""
+    SELECT hits.rowid % 2 AS kind, documents.id AS document_id, documents.name AS name, hits.snippet AS snippet
+    FROM (SELECT rowid, snippet(search_index, 0, '«', '»', '…', 12) AS snippet, rank
+          FROM search_index WHERE search_index MATCH :query ORDER BY rank LIMIT :limit) AS hits
+    LEFT JOIN document_texts ON hits.rowid % 2 = 0 AND document_texts.text_id = hits.rowid / 2
+    LEFT JOIN document_attachments ON hits.rowid % 2 = 1 AND document_attachments.attachment_id = hits.rowid / 2
+    JOIN documents ON documents.id = coalesce(document_texts.document_id, document_attachments.document_id)
+    ORDER BY hits.rank
+""")
+
+SearchHit = namedtuple('SearchHit', ['kind', 'document_id', 'name', 'snippet'])
+
+def create_index(connection):
+    exists = connection.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'")).first()
+    if exists:
+        return False
+    for statement in SCHEMA:
+        connection.execute(text(statement))
+    rebuild_index(connection)
+    return True
+
+def rebuild_index(connection):
+    connection.execute(text("DELETE FROM search_index"))
+    connection.execute(text("INSERT INTO search_index(rowid, body) SELECT id * 2, text FROM texts"))
+    attachments = connection.execute(select(Attachment.id, Attachment.data, Attachment.compression, Attachment.mime)
+                                     .execution_options(yield_per=100))
+    for partition in attachments.partitions():
+        index_attachments(connection, [(id, attachment_body(data, compression, mime))
+                                       for id, data, compression, mime in partition])
+    connection.execute(text("INSERT INTO search_index(search_index) VALUES ('optimize')"))
+
+def attachment_body(data, compression, mime):
+    return decompress(data, compression).decode('utf-8', errors='replace') if is_text(mime) else None
+
+def index_attachments(connection, attachments):
+    rows = [{'rowid': id * 2 + 1, 'body': body} for id, body in attachments if body is not None]
+    if rows:
+        connection.execute(text("INSERT INTO search_index(rowid, body) VALUES (:rowid, :body)"), rows)
+
+def match_expression(query):
+    # Every word is quoted so user input can never be parsed as FTS5 syntax;
+    # the last one is a prefix query so results show up while typing.
+    terms = ['"%s"' % term.replace('"', '""') for term in query.split()]
+    if not terms:
+        return None
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+def search(session, query, limit=50):
+    expression = match_expression(query)
+    if expression is None:
+        return []
+    rows = session.execute(SEARCH, {'query': expression, 'limit': limit})
+    return [SearchHit(*row) for row in rows]
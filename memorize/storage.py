@@ -0,0 +1,306 @@
+import os
+import os.path
+from os import makedirs
+from collections import namedtuple
+from mimetypes import guess_extension, guess_type
+from sqlalchemy import URL, create_engine, delete, event, select
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import selectinload
+from .models import blob_digest, Document, Text, Image, Attachment, DocumentText, DocumentImage, DocumentAttachment
+from .search import create_index, rebuild_index, attachment_body, index_attachments
+from .blobs import compress, decompress_stream, is_text
+from .revisions import DEFAULT_RETENTION, add_revisions
+from .migrations import upgrade
+
+BLOB_CHUNK_SIZE = 1 << 20
+EXTENSIONS = {'jpeg': 'jpg', 'svg+xml': 'svg'}
+
+DocumentData = namedtuple('DocumentData', ['id', 'content', 'images', 'attachments'])
+Item = namedtuple('Item', ['id', 'created_at'])
+AttachmentItem = namedtuple('AttachmentItem', ['id', 'created_at', 'name', 'mime', 'size'])
+ImageItem = namedtuple('ImageItem', ['id', 'created_at', 'thumbnail'])
+
+EngineProfile = namedtuple('EngineProfile', ['kdf_iter', 'cipher_page_size', 'journal_mode', 'synchronous',
+                                             'cache_size', 'mmap_size', 'temp_store', 'echo'],
+                           defaults=[64000, None, 'wal', 'normal', -16384, 0, 'memory', False])
+DEFAULT_PROFILE = EngineProfile()
+CIPHER = 'aes-256-cfb'
+
+def engine_url(path, password, profile):
+    # kdf_iter and cipher_page_size must match the settings the file was
+    # written with; the dialect applies them right after the key.
+    query = {'cipher': CIPHER, 'kdf_iter': str(int(profile.kdf_iter))}
+    if profile.cipher_page_size:
+        query['cipher_page_size'] = str(int(profile.cipher_page_size))
+    return URL.create('sqlite+pysqlcipher', password=password, database=path, query=query)
+
+def apply_profile(profile, read_only):
+    def connect(connection, _):
+        cursor = connection.cursor()
+        # WAL lets the read-only workers query while the writer commits.
+        if not read_only:
+            cursor.execute(f"PRAGMA journal_mode = {profile.journal_mode}")
+        cursor.execute(f"PRAGMA synchronous = {profile.synchronous}")
+        cursor.execute(f"PRAGMA cache_size = {int(profile.cache_size)}")
+        cursor.execute(f"PRAGMA mmap_size = {int(profile.mmap_size)}")
+        cursor.execute(f"PRAGMA temp_store = {profile.temp_store}")
+        cursor.execute("PRAGMA foreign_keys = ON")
+        if read_only:
+            cursor.execute("PRAGMA query_only = ON")
+        cursor.close()
+    return connect
+
+def open_engine(path, password, read_only=False, profile=DEFAULT_PROFILE):
+    # Engines are shared by the database worker threads, so pooled
+    # connections must not be tied to the thread that opened them.
+    engine = create_engine(engine_url(path, password, profile), echo=profile.echo,
+                           connect_args={'check_same_thread': False})
+    event.listen(engine, 'connect', apply_profile(profile, read_only))
+    if read_only:
+        return engine
+    # A wrong key fails here; the engine's pool must not keep the file open.
+    try:
+        upgrade(engine)
+        with engine.begin() as connection:
+            create_index(connection)
+    except Exception:
+        engine.dispose()
+        raise
+    return engine
+
+def export_database(path, password, profile, target, new_password, new_profile):
+    # sqlcipher_export copies the whole database into a fresh file that is
+    # encrypted with the new key and cipher settings, dropping free pages
+    # on the way.
+    engine = create_engine(engine_url(path, password, profile), poolclass=NullPool)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        cursor.execute("ATTACH DATABASE ? AS repacked KEY ?", (target, new_password))
+        cursor.execute(f"PRAGMA repacked.cipher = '{CIPHER}'")
+        cursor.execute(f"PRAGMA repacked.kdf_iter = {int(new_profile.kdf_iter)}")
+        if new_profile.cipher_page_size:
+            cursor.execute(f"PRAGMA repacked.cipher_page_size = {int(new_profile.cipher_page_size)}")
+        cursor.execute("SELECT sqlcipher_export('repacked')")
+        cursor.execute(f"PRAGMA repacked.user_version = {int(version)}")
+        connection.commit()
+        cursor.execute("DETACH DATABASE repacked")
+        cursor.close()
+    except Exception:
+        connection.close()
+        engine.dispose()
+        if os.path.exists(target):
+            os.remove(target)
+        raise
+    connection.close()
+    engine.dispose()
+
+def repack_database(path, password, profile, new_password, new_profile):
+    # The copy replaces the original once it is complete.
+    target = path + '.repack'
+    if os.path.exists(target):
+        os.remove(target)
+    export_database(path, password, profile, target, new_password, new_profile)
+    os.replace(target, path)
+
+def image_extension(format):
+    return EXTENSIONS.get(format, format or 'png')
+
+def get_document(session, document_id):
+    # Served from the session identity map once the document is loaded.
+    return session.get_one(Document, document_id)
+
+def find_documents(session, name):
+    return list(session.scalars(select(Document.id).where(Document.name == name).order_by(Document.id)))
+
+def list_documents(session):
+    return session.execute(select(Document.id, Document.name).order_by(Document.id)).all()
+
+def load_documents(session, document_ids):
+    # Only metadata and thumbnails are read here; image and attachment
+    # payloads stay in the database until they are opened.
+    contents, images, attachments = {}, {}, {}
+    for document_id, content in session.execute(
+            select(DocumentText.document_id, Text.text).join(Text)
+            .where(DocumentText.document_id.in_(document_ids)).order_by(DocumentText.id)):
+        contents.setdefault(document_id, []).append(content)
+    for document_id, *item in session.execute(
+            select(DocumentImage.document_id, DocumentImage.id, Image.created_at, Image.thumbnail).join(Image)
+            .where(DocumentImage.document_id.in_(document_ids)).order_by(DocumentImage.id)):
+        images.setdefault(document_id, []).append(ImageItem(*item))
+    for document_id, *item in session.execute(
+            select(DocumentAttachment.document_id, DocumentAttachment.id, Attachment.created_at,
+                   DocumentAttachment.name, DocumentAttachment.mime, Attachment.size).join(Attachment)
+            .where(DocumentAttachment.document_id.in_(document_ids)).order_by(DocumentAttachment.id)):
+        attachments.setdefault(document_id, []).append(AttachmentItem(*item))
+    return [DocumentData(document_id, ''.join(contents.get(document_id, [])),
+                         images.get(document_id, []), attachments.get(document_id, []))
+            for document_id in session.scalars(select(Document.id).where(Document.id.in_(document_ids)))]
+
+def save_texts(session, contents, policy=DEFAULT_RETENTION):
+    query = select(DocumentText).where(DocumentText.document_id.in_(contents)).order_by(
+        DocumentText.id).options(selectinload(DocumentText.text).undefer(Text.text))
+    saved, changes = set(), {}
+    for document_text in session.scalars(query):
+        if document_text.document_id not in saved:
+            saved.add(document_text.document_id)
+            changes[document_text.document_id] = (document_text.text.text, contents[document_text.document_id])
+            document_text.text.text = contents[document_text.document_id]
+    add_revisions(session, changes, policy)
+    session.commit()
+
+def add_document(session, name, content=''):
+    document = Document(name=name)
+    text = Text(text=content)
+    session.add(document)
+    session.add(text)
+    session.flush()
+    session.add(DocumentText(document_id=document.id, text_id=text.id))
+    session.commit()
+    return document.id
+
+def import_document(session, path):
+    with open(path, 'rt') as file:
+        contents = file.read()
+    return add_document(session, os.path.basename(path), contents)
+
+def rename_document(session, document_id, new_name):
+    get_document(session, document_id).name = new_name
+    session.commit()
+
+def delete_documents(session, document_ids, chunk_size=500):
+    # Link rows go away with their note, text or blob through ON DELETE
+    # CASCADE, so nothing has to be loaded. Blobs are shared between notes
+    # and are only removed when no other note links them.
+    for start in range(0, len(document_ids), chunk_size):
+        ids = document_ids[start:start + chunk_size]
+        session.execute(delete(Image).where(
+            Image.id.in_(select(DocumentImage.image_id).where(DocumentImage.document_id.in_(ids))),
+            ~select(DocumentImage.id).where(DocumentImage.image_id == Image.id,
+                                            DocumentImage.document_id.not_in(ids)).exists()))
+        session.execute(delete(Attachment).where(
+            Attachment.id.in_(select(DocumentAttachment.attachment_id).where(DocumentAttachment.document_id.in_(ids))),
+            ~select(DocumentAttachment.id).where(DocumentAttachment.attachment_id == Attachment.id,
+                                                 DocumentAttachment.document_id.not_in(ids)).exists()))
+        session.execute(delete(Text).where(
+            Text.id.in_(select(DocumentText.text_id).where(DocumentText.document_id.in_(ids)))))
+        session.execute(delete(Document).where(Document.id.in_(ids)))
+    session.commit()
+    return document_ids
+
+def export_document(session, document_id, path):
+    document = get_document(session, document_id)
+    content = ''.join(text.text.text for text in document.document_texts)
+    with open(path, 'wt') as file:
+        file.write(content)
+    dir = os.path.dirname(path)
+    if len(document.document_images) > 0:
+        if not os.path.isdir(os.path.join(dir, 'images')):
+            makedirs(os.path.join(dir, 'images'))
+        for index, image in enumerate(document.document_images):
+            with open(os.path.join(dir, 'images', f'{index}.{image_extension(image.image.format)}'), 'wb') as file:
+                for chunk in read_blob(session, Image.image, image.image_id):
+                    file.write(chunk)
+    if len(document.document_attachments) > 0:
+        if not os.path.isdir(os.path.join(dir, 'attachments')):
+            makedirs(os.path.join(dir, 'attachments'))
+        for index, attachment in enumerate(document.document_attachments):
+            name = f'{index}{attachment_extension(attachment.name, attachment.mime)}'
+            with open(os.path.join(dir, 'attachments', name), 'wb') as file:
+                for chunk in attachment_chunks(session, attachment.attachment_id):
+                    file.write(chunk)
+
+def read_blob(session, column, row_id, chunk_size=BLOB_CHUNK_SIZE):
+    # Yields a blob piece by piece when the driver has incremental blob
+    # I/O (sqlite3's blobopen). pysqlcipher3 has none, and every substr()
+    # window would load and decrypt the whole value again, so there the
+    # blob is read once and yielded whole.
+    connection = session.connection().connection.dbapi_connection
+    if hasattr(connection, 'blobopen'):
+        with connection.blobopen(column.class_.__tablename__, column.key, row_id, readonly=True) as blob:
+            while chunk := blob.read(chunk_size):
+                yield chunk
+        return
+    data = session.scalar(select(column).where(column.class_.id == row_id))
+    if data:
+        yield data
+
+def store_image(session, data, format='png', thumbnail=None, width=None, height=None):
+    digest = blob_digest(data)
+    image_id = session.scalar(select(Image.id).where(Image.digest == digest))
+    if image_id is None:
+        image = Image(image=data, digest=digest, format=format, thumbnail=thumbnail, width=width, height=height)
+        session.add(image)
+        session.flush()
+        image_id = image.id
+    return image_id
+
+def store_attachment(session, data, mime=None):
+    digest = blob_digest(data)
+    attachment_id = session.scalar(select(Attachment.id).where(Attachment.digest == digest))
+    if attachment_id is None:
+        mime = mime or 'application/octet-stream'
+        payload, compression = compress(data, mime)
+        attachment = Attachment(data=payload, mime=mime, size=len(data), compression=compression,
+                                digest=digest)
+        session.add(attachment)
+        session.flush()
+        attachment_id = attachment.id
+        index_attachments(session.connection(), [(attachment_id, attachment_body(payload, compression, mime))])
+    return attachment_id
+
+def add_image(session, document_id, data, format='png', thumbnail=None, width=None, height=None, name=None):
+    image_id = store_image(session, data, format, thumbnail, width, height)
+    session.add(DocumentImage(document_id=get_document(session, document_id).id, image_id=image_id, name=name))
+    session.commit()
+
+def add_attachment(session, document_id, path):
+    mime, _ = guess_type(path)
+    with open(path, 'rb') as file:
+        attachment_id = store_attachment(session, file.read(), mime)
+    session.add(DocumentAttachment(document_id=get_document(session, document_id).id, attachment_id=attachment_id,
+                                   name=os.path.basename(path), mime=mime or 'application/octet-stream'))
+    session.commit()
+
+def image_data(session, document_image_id):
+    document_image = session.get(DocumentImage, document_image_id)
+    return document_image.image.image if document_image else None
+
+def set_thumbnail(session, document_image_id, thumbnail):
+    document_image = session.get(DocumentImage, document_image_id)
+    if document_image is not None:
+        document_image.image.thumbnail = thumbnail
+        session.commit()
+
+def attachment_extension(name, mime):
+    extension = os.path.splitext(name or '')[1]
+    return extension or guess_extension(mime or '') or '.bin'
+
+def attachment_chunks(session, attachment_id):
+    compression = session.scalar(select(Attachment.compression).where(Attachment.id == attachment_id))
+    return decompress_stream(read_blob(session, Attachment.data, attachment_id), compression)
+
+def read_attachment(session, document_attachment_id, on_chunk):
+    # Text is passed to on_chunk piece by piece as it is decompressed;
+    # binary attachments are only described.
+    document_attachment = session.get(DocumentAttachment, document_attachment_id)
+    if document_attachment is None:
+        return None
+    attachment = document_attachment.attachment
+    info = AttachmentItem(document_attachment.id, attachment.created_at, document_attachment.name,
+                          document_attachment.mime, attachment.size)
+    if is_text(document_attachment.mime):
+        for chunk in attachment_chunks(session, attachment.id):
+            on_chunk(chunk)
+    return info
+
+def save_attachment(session, document_attachment_id, path):
+    document_attachment = session.get(DocumentAttachment, document_attachment_id)
+    with open(path, 'wb') as file:
+        for chunk in attachment_chunks(session, document_attachment.attachment_id):
+            file.write(chunk)
+
+def rebuild_search_index(session):
+    rebuild_index(session.connection())
+    session.commit()
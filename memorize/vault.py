@@ -0,0 +1,102 @@
+import os.path
+from mimetypes import guess_type
+from sqlalchemy.orm import sessionmaker
+from .storage import DEFAULT_PROFILE, open_engine, repack_database, find_documents, list_documents, load_documents
+from .storage import save_texts, add_document, import_document, rename_document, delete_documents, export_document
+from .storage import add_image, add_attachment, rebuild_search_index
+from .importer import import_directory
+from .exporter import export_all
+from .search import search
+from .revisions import DEFAULT_RETENTION, list_revisions, revision_text
+from .models import Document
+
+# A Vault is one open database with its own session. It wraps the same
+# storage functions the GUI runs on its database worker, for scripts and
+# the command line; it must be used from a single thread.
+
+class Vault:
+    def __init__(self, path, password, profile=DEFAULT_PROFILE, read_only=False):
+        # Opening a missing file would create an empty one, which a read-only
+        # engine cannot set up.
+        if read_only and not os.path.isfile(path):
+            raise FileNotFoundError(f'no such database: {path}')
+        self.path, self.password, self.profile = path, password, profile
+        self.engine = open_engine(path, password, read_only, profile)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def notes(self):
+        return list_documents(self.session)
+
+    def exists(self, document_id):
+        return self.session.get(Document, document_id) is not None
+
+    def find(self, name):
+        return find_documents(self.session, name)
+
+    def read(self, document_id):
+        documents = load_documents(self.session, [document_id])
+        if not documents:
+            raise KeyError(document_id)
+        return documents[0].content
+
+    def write(self, document_id, content, policy=DEFAULT_RETENTION):
+        save_texts(self.session, {document_id: content}, policy)
+
+    def add(self, name, content=''):
+        return add_document(self.session, name, content)
+
+    def rename(self, document_id, name):
+        rename_document(self.session, document_id, name)
+
+    def delete(self, document_ids):
+        return delete_documents(self.session, list(document_ids))
+
+    def import_file(self, path):
+        return import_document(self.session, path)
+
+    def import_directory(self, root, progress=None, **options):
+        return import_directory(self.session, root, progress, **options)
+
+    def export(self, target, progress=None, **options):
+        return export_all(self.session, target, progress, **options)
+
+    def export_note(self, document_id, path):
+        export_document(self.session, document_id, path)
+
+    def add_image(self, document_id, path):
+        # The thumbnail needs Qt; the GUI creates it when the note is shown.
+        mime, _ = guess_type(path)
+        with open(path, 'rb') as file:
+            add_image(self.session, document_id, file.read(), mime.split('/')[1] if mime else 'png',
+                      name=os.path.basename(path))
+
+    def add_attachment(self, document_id, path):
+        add_attachment(self.session, document_id, path)
+
+    def search(self, query, limit=50):
+        return search(self.session, query, limit)
+
+    def revisions(self, document_id):
+        return list_revisions(self.session, document_id)
+
+    def revision(self, document_id, number):
+        return revision_text(self.session, document_id, number)
+
+    def rebuild_index(self):
+        rebuild_search_index(self.session)
+
+    def repack(self, new_password=None, new_profile=None):
+        self.close()
+        new_password, new_profile = new_password or self.password, new_profile or self.profile
+        repack_database(self.path, self.password, self.profile, new_password, new_profile)
+        self.__init__(self.path, new_password, new_profile)
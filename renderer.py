@@ -0,0 +1,148 @@
+import re
+from collections import OrderedDict
+from PySide6.QtCore import QObject, QThread, QCoreApplication, Signal, Slot
+from PySide6.QtGui import QTextDocument, QTextCursor, QTextDocumentFragment
+from memorize.instrumentation import count, timer
+
+# Markdown is parsed into QTextDocuments and serialized back on a thread
+# of its own. Documents carry no layout until a QTextEdit shows them, so
+# they can be built there and handed over to the GUI thread afterwards.
+
+CHUNK_SIZE = 64 << 10
+OFF_THREAD_SIZE = 100 << 10
+REFERENCE = re.compile(r'^ {0,3}\[[^\]]+\]:', re.MULTILINE)
+
+def markdown_chunks(text, size=CHUNK_SIZE):
+    # Only split before a heading that follows a blank line outside code
+    # fences: that ends any open block, so the pieces parse the same as
+    # the whole. Reference links may be defined anywhere, so such notes
+    # are parsed in one go.
+    if REFERENCE.search(text):
+        return [text]
+    chunks, start, position, fence, blank = [], 0, 0, False, False
+    for line in text.splitlines(keepends=True):
+        if line.lstrip().startswith(('```', '~~~')):
+            fence = not fence
+        elif not fence and blank and line.startswith('#') and position - start >= size:
+            chunks.append(text[start:position])
+            start = position
+        blank = not line.strip()
+        position += len(line)
+    chunks.append(text[start:])
+    return chunks
+
+def render_markdown(text, cancelled=None):
+    chunks = markdown_chunks(text)
+    document = QTextDocument()
+    document.setMarkdown(chunks[0])
+    cursor = QTextCursor(document)
+    for chunk in chunks[1:]:
+        if cancelled is not None and cancelled():
+            return None
+        part = QTextDocument()
+        part.setMarkdown(chunk)
+        # A fragment is merged into the block it is inserted in; a block
+        # with the fragment's own first format keeps headings intact.
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertBlock(part.firstBlock().blockFormat(), part.firstBlock().charFormat())
+        cursor.insertFragment(QTextDocumentFragment(part))
+    return document
+
+class RenderCache:
+    # Rendered documents by (document id, content hash), least recently
+    # used first. Callers get clones, the cached documents are never shown.
+    def __init__(self, size=16):
+        self.size = size
+        self.documents = OrderedDict()
+
+    def get(self, key):
+        document = self.documents.get(key)
+        count('render cache', document is not None)
+        if document is not None:
+            self.documents.move_to_end(key)
+        return document
+
+    def put(self, key, document):
+        self.documents[key] = document
+        self.documents.move_to_end(key)
+        while len(self.documents) > self.size:
+            self.documents.popitem(last=False)
+
+    def clear(self):
+        self.documents.clear()
+
+class RenderJob:
+    def __init__(self, key, text, document, on_done):
+        self.key = key
+        self.text = text
+        self.document = document
+        self.on_done = on_done
+        self.cancelled = False
+        self.result = None
+
+class RenderWorker(QObject):
+    requested = Signal(object)
+    finished = Signal(object)
+
+    def __init__(self, parent=None):
+        super(RenderWorker, self).__init__(parent)
+        self.requested.connect(self.run)
+
+    @Slot(object)
+    def run(self, job):
+        if job.document is not None:
+            if not job.cancelled:
+                with timer('to_markdown'):
+                    job.result = job.document.toMarkdown()
+            # Dropped here, so the clone is deleted on the thread it was moved to.
+            job.document = None
+        elif not job.cancelled:
+            with timer('render_markdown'):
+                job.result = render_markdown(job.text, lambda: job.cancelled)
+            if job.result is not None:
+                job.result.moveToThread(QCoreApplication.instance().thread())
+        self.finished.emit(job)
+
+class RenderService(QObject):
+    # One job per key at a time: a newer request cancels the older one.
+    def __init__(self, parent=None):
+        super(RenderService, self).__init__(parent)
+        self.jobs = {}
+        self.thread = QThread()
+        self.worker = RenderWorker()
+        self.worker.moveToThread(self.thread)
+        self.worker.finished.connect(self.deliver)
+        self.thread.start()
+
+    def dispatch(self, job):
+        previous = self.jobs.get(job.key)
+        if previous is not None:
+            previous.cancelled = True
+        self.jobs[job.key] = job
+        self.worker.requested.emit(job)
+
+    def render(self, key, text, on_done):
+        self.dispatch(RenderJob(key, text, None, on_done))
+
+    def serialize(self, key, document, on_done):
+        # Takes a clone the caller no longer touches.
+        document.moveToThread(self.thread)
+        self.dispatch(RenderJob(key, None, document, on_done))
+
+    def cancel(self, key):
+        job = self.jobs.pop(key, None)
+        if job is not None:
+            job.cancelled = True
+
+    @Slot(object)
+    def deliver(self, job):
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+        if not job.cancelled and job.result is not None:
+            job.on_done(job.result)
+
+    def shutdown(self):
+        for job in self.jobs.values():
+            job.cancelled = True
+        self.thread.quit()
+        self.thread.wait()
@@ -0,0 +1,210 @@
+from PySide6.QtCore import QObject, QThread, Signal, Slot, Qt
+from sqlalchemy.orm import sessionmaker
+from memorize.storage import DEFAULT_PROFILE, open_engine, repack_database
+from memorize.instrumentation import profiled, timer
+from memorize.keys import derive_key, read_salt, unlock
+
+# All database work runs on worker threads. The writer owns the only
+# session that may write; its jobs run one at a time in submission order,
+# so a sync submitted after a save always sees the saved text. Optional
+# readers open their own query_only connections and serve jobs submitted
+# with read_only=True. Those may overlap with writes, so they must not
+# depend on writes that are still queued.
+
+class Job:
+    def __init__(self, function, args, on_done=None, on_error=None, blocking=False):
+        self.function = function
+        self.args = args
+        self.on_done = on_done
+        self.on_error = on_error
+        self.blocking = blocking
+        self.result = None
+        self.error = None
+
+class Stream(QObject):
+    # Carries pieces of a job's result to the GUI thread while it runs.
+    chunk = Signal(object)
+
+class DatabaseWorker(QObject):
+    requested = Signal(object)
+    requested_blocking = Signal(object)
+    finished = Signal(object)
+
+    def __init__(self, parent=None):
+        super(DatabaseWorker, self).__init__(parent)
+        self.engine, self.session = None, None
+        self.location = None
+        self.password = None
+        self.requested.connect(self.run)
+        self.requested_blocking.connect(self.run, Qt.BlockingQueuedConnection)
+
+    @Slot(object)
+    def run(self, job):
+        try:
+            with profiled(), timer(job.function.__name__):
+                job.result = job.function(self.session, *job.args)
+        except Exception as e:
+            job.error = e
+            if self.session is not None:
+                self.session.rollback()
+        self.finished.emit(job)
+
+    def open(self, session, path, password, read_only=False, profile=DEFAULT_PROFILE, key=None):
+        # The writer derives the raw key itself unless it is given one; the
+        # location keeps the key, so readers and repacks skip the KDF. The
+        # password is kept for re-keying and is None when opened by key.
+        self.close(session)
+        if key is None and not read_only:
+            self.engine, key = unlock(path, password, profile)
+        else:
+            self.engine = open_engine(path, key or password, read_only, profile)
+        self.session = sessionmaker(bind=self.engine)()
+        self.location = (path, key or password, profile)
+        self.password = password
+        return key
+
+    def repack(self, session, new_password, new_profile, password=None):
+        # A raw key carries the old salt and bypasses kdf_iter, so the new
+        # file is always keyed with a password. When the database was opened
+        # by key, the password given for it is checked against that key.
+        path, secret, profile = self.location
+        if password is not None and secret != password and derive_key(password, read_salt(path), profile) != secret:
+            raise ValueError('wrong password')
+        password = password or self.password
+        new_password = new_password or password
+        if new_password is None:
+            raise ValueError('the password is needed to repack a database opened by key')
+        self.close(session)
+        try:
+            repack_database(path, secret, profile, new_password, new_profile)
+        except Exception:
+            self.open(None, path, password, profile=profile, key=secret if secret != password else None)
+            raise
+        return self.open(None, path, new_password, profile=new_profile)
+
+    def close(self, session):
+        if self.session is not None:
+            self.session.close()
+            self.engine.dispose()
+        self.engine, self.session = None, None
+
+class DatabaseService(QObject):
+    busy = Signal(bool)
+    progress = Signal(int, int)
+    # Errors of jobs submitted without on_error.
+    failed = Signal(object)
+
+    def __init__(self, readers=0, parent=None):
+        super(DatabaseService, self).__init__(parent)
+        self.pending = 0
+        self.threads = []
+        self.writer = self.start_worker()
+        self.readers = [self.start_worker() for _ in range(readers)]
+        self.next_reader = 0
+
+    def start_worker(self):
+        thread = QThread()
+        worker = DatabaseWorker()
+        worker.moveToThread(thread)
+        worker.finished.connect(self.deliver)
+        thread.start()
+        self.threads.append(thread)
+        return worker
+
+    def dispatch(self, worker, job):
+        self.pending += 1
+        if self.pending == 1:
+            self.busy.emit(True)
+        worker.requested.emit(job)
+
+    def pick(self, read_only):
+        worker = self.writer
+        if read_only and self.readers:
+            worker = self.readers[self.next_reader % len(self.readers)]
+            self.next_reader += 1
+        return worker
+
+    def submit(self, function, *args, on_done=None, on_error=None, read_only=False):
+        self.dispatch(self.pick(read_only), Job(function, args, on_done, on_error))
+
+    def submit_with_location(self, function, *args, on_done=None, on_error=None, read_only=False):
+        # function gets the path, password and profile of the open database
+        # instead of the session, for work that opens its own connections.
+        worker = self.pick(read_only)
+
+        def located(session):
+            return function(*worker.location, *args)
+        located.__name__ = function.__name__
+        self.dispatch(worker, Job(located, (), on_done, on_error))
+
+    def stream(self, function, *args, on_chunk, on_done=None, on_error=None, read_only=False):
+        # function gets a callback for the chunks after args; they are
+        # delivered to on_chunk in order, before on_done.
+        stream = Stream(self)
+        stream.chunk.connect(on_chunk)
+
+        def finished(callback, result):
+            stream.deleteLater()
+            if callback is not None:
+                callback(result)
+        self.submit(function, *args, stream.chunk.emit, read_only=read_only,
+                    on_done=lambda result: finished(on_done, result),
+                    on_error=lambda error: finished(on_error or self.failed.emit, error))
+
+    def report_progress(self, done, total):
+        self.progress.emit(done, total)
+
+    @Slot(object)
+    def deliver(self, job):
+        if job.blocking:
+            return
+        self.pending -= 1
+        if self.pending == 0:
+            self.busy.emit(False)
+        if job.error is not None:
+            if job.on_error is not None:
+                job.on_error(job.error)
+            else:
+                self.failed.emit(job.error)
+        elif job.on_done is not None:
+            job.on_done(job.result)
+
+    def open(self, path, password, profile=DEFAULT_PROFILE, on_done=None, on_error=None, key=None):
+        # on_done gets the raw key the database was opened with, if any.
+        def opened(result):
+            self.open_readers()
+            if on_done is not None:
+                on_done(result)
+        self.dispatch(self.writer, Job(self.writer.open, (path, password, False, profile, key), opened, on_error))
+
+    def open_readers(self):
+        path, password, profile = self.writer.location
+        for reader in self.readers:
+            self.dispatch(reader, Job(reader.open, (path, password, True, profile)))
+
+    def repack(self, new_password, new_profile, on_done=None, on_error=None, password=None):
+        # Readers must let go of the file before the writer replaces it.
+        for reader in self.readers:
+            reader.requested_blocking.emit(Job(reader.close, (), blocking=True))
+
+        def finished(callback, result):
+            self.open_readers()
+            if callback is not None:
+                callback(result)
+        self.dispatch(self.writer, Job(self.writer.repack, (new_password, new_profile, password),
+                                       lambda result: finished(on_done, result),
+                                       lambda error: finished(on_error or self.failed.emit, error)))
+
+    def close(self):
+        for worker in [self.writer] + self.readers:
+            self.dispatch(worker, Job(worker.close, ()))
+
+    def shutdown(self):
+        if not self.threads[0].isRunning():
+            return
+        for worker in [self.writer] + self.readers:
+            job = Job(worker.close, (), blocking=True)
+            worker.requested_blocking.emit(job)
+        for thread in self.threads:
+            thread.quit()
+            thread.wait()